@@ -0,0 +1,32 @@
+#######################################################################################
+# FUNCTIONS for the python actions reading/writing Arrow files
+#######################################################################################
+import numpy as np
+import pyarrow as pa
+
+# dates are handled as int32 days since 1970-01-01; missing dates get this sentinel
+missing_day = np.iinfo(np.int32).max
+
+#######################################################################################
+### READ and WRITE
+#######################################################################################
+# Read an Arrow (feather v2) file, memory-mapped so columns are only paged in when used
+def read_arrow(path):
+    with pa.memory_map(str(path), "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+def write_arrow(table, path):
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+#######################################################################################
+### DATES <-> int32 days
+#######################################################################################
+def date_column_as_days(table, column_name):
+    column = table.column(column_name).cast(pa.date32()).cast(pa.int32())
+    return column.fill_null(missing_day).to_numpy()
+
+def days_as_date_array(days):
+    days = np.asarray(days, dtype=np.int32)
+    return pa.array(days, mask=(days == missing_day)).cast(pa.date32())
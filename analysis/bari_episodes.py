@@ -0,0 +1,116 @@
+################################################################################
+## This script does the following:
+# 1. Import the ranked baricitinib treatment dates (both settings) from
+#    dataset_ranks.arrow (generate_dataset_ranks, `-- --ranks N`)
+# 2. Collapse each patient's distinct treatment dates into treatment episodes: a new
+#    episode starts when a treatment date is more than --gap-days after the previous one
+# 3. Save one row per patient with the episodes as compact per-patient arrays:
+#    start date, end date, number of distinct treatment dates and setting(s) of each
+#    episode
+# Only the first N treatment dates per setting are extracted: the number of patients
+# with a date in the last rank (who may have more treatments) is logged.
+################################################################################
+import argparse
+import sys
+
+import numpy as np
+import pyarrow as pa
+
+from arrow_helper_functions import (
+    date_column_as_days,
+    days_as_date_array,
+    missing_day,
+    read_arrow,
+    write_arrow,
+)
+
+################################################################################
+# 0 Settings: covid_indication -> prefix of its ranked treatment date columns
+################################################################################
+settings = {
+    "hospitalised_with": "exp_date_bari_hosp_rank_",
+    "hospital_onset": "exp_date_bari_hosp_onset_rank_",
+}
+# setting labels by bitmask of the settings seen within one episode
+setting_labels = ["hospitalised_with", "hospital_onset", "hospitalised_with;hospital_onset"]
+
+################################################################################
+# 1 Collapse treatment dates into episodes, in one pass over the sorted dates
+################################################################################
+# patients with a date in the last extracted rank of each setting: they hit the cap
+def patients_at_cap(table):
+    at_cap = {}
+    for setting, prefix in settings.items():
+        column_names = sorted(name for name in table.column_names if name.startswith(prefix))
+        if column_names:
+            at_cap[setting] = (column_names[-1], table.num_rows - table.column(column_names[-1]).null_count)
+    return at_cap
+
+def build_episodes(table, gap_days):
+    n_patients = table.num_rows
+    dates, bits = [], []
+    for bit, prefix in enumerate(settings.values()):
+        for column_name in sorted(name for name in table.column_names if name.startswith(prefix)):
+            dates.append(date_column_as_days(table, column_name))
+            bits.append(np.full(n_patients, 1 << bit, dtype=np.int8))
+    dates = np.column_stack(dates)
+    bits = np.column_stack(bits)
+
+    # sort each patient's dates (missing dates last), then flatten patient by patient
+    order = np.argsort(dates, axis=1, kind="stable")
+    dates = np.take_along_axis(dates, order, axis=1)
+    bits = np.take_along_axis(bits, order, axis=1)
+    valid = dates != missing_day
+    patient_index = np.nonzero(valid)[0]
+    dates = dates[valid]
+    bits = bits[valid]
+    # the same date in both settings is one treatment date (of both settings)
+    same_date = np.zeros(len(dates), dtype=bool)
+    same_date[1:] = (patient_index[1:] == patient_index[:-1]) & (dates[1:] == dates[:-1])
+    bits[np.flatnonzero(same_date) - 1] |= bits[same_date]
+    patient_index = patient_index[~same_date]
+    dates = dates[~same_date]
+    bits = bits[~same_date]
+
+    new_episode = np.ones(len(dates), dtype=bool)
+    new_episode[1:] = (patient_index[1:] != patient_index[:-1]) | (np.diff(dates) > gap_days)
+    starts = np.flatnonzero(new_episode)
+    ends = np.append(starts[1:], len(dates))
+
+    episodes_per_patient = np.bincount(patient_index[starts], minlength=n_patients)
+    offsets = pa.array(np.concatenate([[0], np.cumsum(episodes_per_patient)]), type=pa.int32())
+    if len(starts):
+        episode_bits = np.bitwise_or.reduceat(bits, starts)
+    else:
+        episode_bits = np.zeros(0, dtype=np.int8)
+    episode_settings = pa.DictionaryArray.from_arrays(
+        pa.array(episode_bits - 1, type=pa.int8()), pa.array(setting_labels)
+    )
+    return pa.table({
+        "patient_id": table.column("patient_id"),
+        "n_episodes": pa.array(episodes_per_patient, type=pa.int32()),
+        "episode_start_date": pa.ListArray.from_arrays(offsets, days_as_date_array(dates[starts])),
+        "episode_end_date": pa.ListArray.from_arrays(offsets, days_as_date_array(dates[ends - 1])),
+        "episode_n_treatments": pa.ListArray.from_arrays(offsets, pa.array(ends - starts, type=pa.int32())),
+        "episode_setting": pa.ListArray.from_arrays(offsets, episode_settings),
+    })
+
+################################################################################
+# 2 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/dataset_ranks.arrow")
+    parser.add_argument("--output", default="output/bari_episodes.arrow")
+    parser.add_argument("--gap-days", type=int, default=14)
+    args = parser.parse_args()
+
+    table = read_arrow(args.input)
+    for setting, (column_name, n_at_cap) in patients_at_cap(table).items():
+        if n_at_cap:
+            print(f"{setting}: {n_at_cap} patients have a treatment date in {column_name}, the last extracted rank; later treatments are missing (raise --ranks)", file=sys.stderr)
+    episodes = build_episodes(table, args.gap_days)
+    write_arrow(episodes, args.output)
+
+if __name__ == "__main__":
+    main()
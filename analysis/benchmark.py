@@ -0,0 +1,145 @@
+################################################################################
+## This script does the following:
+# 1. Generate synthetic populations of increasing size (analysis/dummy_data.py), once
+#    per size and outside the measured steps
+# 2. Run the ehrQL dataset definition (analysis/dataset_definition.py) on each of them
+#    with `generate-dataset --dummy-tables`: once limited to each variable
+#    (-- --variables <name>) and once with all variables, recording the wall-clock time
+#    and the peak resident memory of every run. Every run also extracts the population
+#    (stage 1 of the definition), so a variable's own cost is its time above the
+#    cheapest run
+# 3. Estimate how each variable scales with population size and flag super-linear
+#    scaling (e.g. the chained second/third exposure dates or the emergency care lookups)
+# 4. Save the results as JSON, tagged with the git commit, so runs on different
+#    commits can be compared (--baseline)
+#
+# The results are for ehrQL's in-memory dummy-table engine only, not for the TPP
+# backend: they rank the variables and show how each scales on that engine, and the
+# largest default scale is 1M patients, as that engine holds every table in memory.
+# Peak memory is the maximum RSS of the generate-dataset process (Arrow and database
+# buffers included), so it is only meaningful when --command runs ehrQL directly, not
+# through a container. Needs ehrQL installed (e.g. the codespace):
+#   python analysis/benchmark.py --scales 10000 100000 1000000
+################################################################################
+import argparse
+import datetime
+import json
+import os
+import shlex
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import dummy_data
+from query_report import load_variables
+
+# a variable scales super-linearly if time grows faster than n ** superlinear_exponent;
+# variables faster than min_seconds at the largest scale are too noisy to judge
+superlinear_exponent = 1.15
+min_seconds = 0.05
+
+################################################################################
+# 1 Time and peak memory of one generate-dataset run
+################################################################################
+# The run is a child process, waited for with os.wait4 to get its own resource usage:
+# ru_maxrss is its peak RSS in kilobytes (Linux)
+def measure(command, definition, tables_dir, params=()):
+    with tempfile.TemporaryDirectory() as output_dir:
+        args = [*shlex.split(command), definition, "--output", f"{output_dir}/dataset.arrow", "--dummy-tables", tables_dir]
+        if params:
+            args += ["--", *params]
+        start = time.perf_counter()
+        process = subprocess.Popen(args)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status) # already reaped: stop Popen waiting for it
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return {"seconds": round(seconds, 4), "peak_mb": round(usage.ru_maxrss / 1e3, 1)}
+
+################################################################################
+# 2 One population size
+################################################################################
+def benchmark_scale(population_size, tables_dir, command, definition, names):
+    dummy_data.write_tables(tables_dir, population_size)
+    timings = {name: measure(command, definition, tables_dir, ["--variables", name]) for name in names}
+    timings["all_variables"] = measure(command, definition, tables_dir)
+    return {"timings": timings}
+
+################################################################################
+# 3 Scaling exponent per step: slope of log(seconds) against log(population size)
+################################################################################
+def scaling(results):
+    sizes = sorted(results, key=int)
+    exponents, flagged = {}, []
+    if len(sizes) < 2:
+        return exponents, flagged
+    for step in results[sizes[-1]]["timings"]:
+        seconds = np.array([max(results[size]["timings"][step]["seconds"], 1e-6) for size in sizes])
+        exponent = np.polyfit(np.log([int(size) for size in sizes]), np.log(seconds), 1)[0]
+        exponents[step] = round(float(exponent), 2)
+        if exponent > superlinear_exponent and seconds[-1] >= min_seconds:
+            flagged.append(step)
+    return exponents, flagged
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+################################################################################
+# 4 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--output-dir", default="output/benchmarks")
+    parser.add_argument("--baseline", help="earlier benchmark JSON to compare the largest shared scale with")
+    parser.add_argument("--definition", default="analysis/dataset_definition.py")
+    parser.add_argument("--command", default="ehrql generate-dataset", help="command running generate-dataset")
+    parser.add_argument("--variables", nargs="*", help="only benchmark these variables (default: every variable of the definition)")
+    args = parser.parse_args()
+
+    names = args.variables or [name for name in load_variables(args.definition)[0] if name != "population"]
+    results = {}
+    for population_size in args.scales:
+        with tempfile.TemporaryDirectory() as tables_dir:
+            results[str(population_size)] = benchmark_scale(population_size, tables_dir, args.command, args.definition, names)
+        print(f"{population_size} patients: {results[str(population_size)]['timings']['all_variables']['seconds']:.2f}s for all variables")
+    exponents, flagged = scaling(results)
+
+    commit = git_commit()
+    benchmark = {
+        "commit": commit,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "results": results,
+        "scaling_exponents": exponents,
+        "superlinear": flagged,
+    }
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / f"benchmark_{commit}.json", "w") as f:
+        json.dump(benchmark, f, indent=2)
+    for step in flagged:
+        print(f"super-linear scaling: {step} (exponent {exponents[step]})")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        shared = sorted(set(baseline["results"]) & set(results), key=int)
+        if shared:
+            size = shared[-1]
+            print(f"time relative to {baseline['commit']} at {size} patients:")
+            for step, timing in results[size]["timings"].items():
+                before = baseline["results"][size]["timings"].get(step)
+                if before:
+                    print(f"  {step}: {timing['seconds'] / max(before['seconds'], 1e-6):.2f}x")
+
+if __name__ == "__main__":
+    main()
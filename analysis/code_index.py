@@ -0,0 +1,241 @@
+#######################################################################################
+# CODE-OCCURRENCE index: per (patient, code) the sorted occurrence dates, on disk
+#######################################################################################
+# Built once per data refresh from the TPP-shaped tables of analysis/local_engine.py,
+# for each indexed (table, code column) in its own directory of .npy files, all
+# memory-mapped when loaded:
+#   codes.npy         sorted distinct codes
+#   code_offsets.npy  pairs of codes[i] are code_offsets[i]:code_offsets[i + 1]
+#   pair_patients.npy patient_id of each (code, patient) pair, sorted within each code
+#   pair_offsets.npy  occurrences of pair j are pair_offsets[j]:pair_offsets[j + 1]
+#   keys.npy          one int64 per occurrence: j * 2**32 + (date + 2**31), so all keys
+#                     are sorted and any date window of any pair is a binary search
+# An indexed column can be the union of several code columns: apcs/diagnosis holds the
+# primary and the secondary diagnosis of each admission, with a code that is in both
+# counted once for that admission.
+# manifest.json records the source file (size, mtime) of each entry, so a stale index
+# is refused. The index does not depend on codelists or study dates, so sibling
+# studies on the same data refresh can share it (--index-dir).
+#
+# The local engine answers first/last (date)/count/exists variables on one indexed code
+# column without a where-condition from the index (local_engine.py --code-index DIR),
+# and first/last/exists variables on the primary OR secondary diagnosis of apcs from
+# apcs/diagnosis. Counts of admissions are not: an admission with two different codes
+# of the codelist is one occurrence of each. All other variables are still evaluated
+# on the tables.
+#
+#   python analysis/code_index.py --tables <dir> --index-dir output/code_index
+import argparse
+import datetime
+import json
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from arrow_helper_functions import missing_day
+from local_engine import (
+    as_days,
+    evaluate_variable,
+    event_date_columns,
+    parse_day,
+    read_table,
+    source_file,
+    source_stamp,
+)
+
+# indexed column -> the code columns it is built from
+indexed_columns = {
+    "clinical_events": {"snomedct_code": ["snomedct_code"], "ctv3_code": ["ctv3_code"]},
+    "medications": {"dmd_code": ["dmd_code"]},
+    "apcs": {"diagnosis": ["primary_diagnosis", "secondary_diagnosis"]},
+}
+pair_shift = np.int64(2 ** 32)
+date_offset = np.int64(2 ** 31)
+
+#######################################################################################
+### BUILD
+#######################################################################################
+def build_column_index(table, date_column, source_columns):
+    # the codes of all source columns, one (row, code) per row and distinct code
+    codes = pa.chunked_array([chunk for name in source_columns for chunk in table.column(name).cast(pa.string()).chunks], type=pa.string())
+    encoded = pc.dictionary_encode(codes).combine_chunks()
+    indices = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int64)
+    dictionary = encoded.dictionary.to_numpy(zero_copy_only=False).astype(str)
+    row = np.tile(np.arange(table.num_rows, dtype=np.int64), len(source_columns))
+    keep = indices >= 0
+    row, indices = row[keep], indices[keep]
+    if len(source_columns) > 1:
+        row_code = np.unique(row * len(dictionary) + indices)
+        row, indices = row_code // len(dictionary), row_code % len(dictionary)
+    # rank of each code among the sorted distinct codes
+    order = np.argsort(dictionary)
+    rank = np.empty(len(dictionary), dtype=np.int64)
+    rank[order] = np.arange(len(dictionary))
+    code = rank[indices]
+    patient = table.column("patient_id").to_numpy()[row]
+    days = as_days(table.column(date_column))[row].astype(np.int64)
+
+    rows = np.lexsort((days, patient, code))
+    code, patient, days = code[rows], patient[rows], days[rows]
+    new_pair = np.r_[True, (code[1:] != code[:-1]) | (patient[1:] != patient[:-1])] if len(rows) else np.zeros(0, dtype=bool)
+    pair_starts = np.flatnonzero(new_pair)
+    pair = np.cumsum(new_pair) - 1
+    return {
+        "codes": dictionary[order],
+        "code_offsets": np.searchsorted(code[pair_starts], np.arange(len(dictionary) + 1)).astype(np.int64),
+        "pair_patients": patient[pair_starts],
+        "pair_offsets": np.r_[pair_starts, len(rows)].astype(np.int64),
+        "keys": pair * pair_shift + days + date_offset,
+    }
+
+def build_index(tables_dir, index_dir):
+    index_dir = Path(index_dir)
+    manifest = {"created": datetime.datetime.now().isoformat(timespec="seconds"), "entries": {}}
+    for table_name, columns in indexed_columns.items():
+        path = source_file(tables_dir, table_name)
+        table = read_table(tables_dir, table_name)
+        for column_name, source_columns in columns.items():
+            arrays = build_column_index(table, event_date_columns[table_name], source_columns)
+            entry_dir = index_dir / table_name / column_name
+            entry_dir.mkdir(parents=True, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(entry_dir / f"{name}.npy", array)
+            manifest["entries"][f"{table_name}/{column_name}"] = {
+                **source_stamp(path),
+                "n_codes": len(arrays["codes"]),
+                "n_pairs": len(arrays["pair_patients"]),
+                "n_occurrences": len(arrays["keys"]),
+            }
+    with open(index_dir / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+#######################################################################################
+### LOAD
+#######################################################################################
+def load_index(index_dir, tables_dir=None):
+    index_dir = Path(index_dir)
+    with open(index_dir / "manifest.json") as f:
+        manifest = json.load(f)
+    index = {}
+    for entry_name, entry in manifest["entries"].items():
+        if tables_dir is not None:
+            table_name = entry_name.split("/")[0]
+            stamp = source_stamp(source_file(tables_dir, table_name))
+            if (stamp["source_size"], stamp["source_mtime"]) != (entry["source_size"], entry["source_mtime"]):
+                raise ValueError(f"code index {entry_name} is out of date with {stamp['source']}: rebuild it")
+        index[entry_name] = {
+            name: np.load(index_dir / entry_name / f"{name}.npy", mmap_mode="r")
+            for name in ["codes", "code_offsets", "pair_patients", "pair_offsets", "keys"]
+        }
+    return index
+
+#######################################################################################
+### QUERY: all pairs of a codelist, then one binary search per pair and window limit
+#######################################################################################
+# the pairs of the codelist's codes whose patient is in patient_ids (sorted), and the
+# position of that patient in patient_ids
+def codelist_pairs(entry, codelist, patient_ids):
+    codes = np.asarray(sorted(set(codelist)), dtype=str)
+    positions = np.searchsorted(entry["codes"], codes)
+    found = positions < len(entry["codes"])
+    found[found] = entry["codes"][positions[found]] == codes[found]
+    positions = positions[found]
+    starts = entry["code_offsets"][positions]
+    lengths = entry["code_offsets"][positions + 1] - starts
+    pairs = np.repeat(starts - np.cumsum(np.r_[0, lengths[:-1]]), lengths) + np.arange(lengths.sum())
+    patient_positions = np.searchsorted(patient_ids, entry["pair_patients"][pairs])
+    in_population = patient_positions < len(patient_ids)
+    in_population[in_population] = patient_ids[patient_positions[in_population]] == entry["pair_patients"][pairs[in_population]]
+    return pairs[in_population], patient_positions[in_population]
+
+# occurrence range [lo, hi) of each pair within the window (start/end as in local_engine)
+def window_ranges(entry, pairs, positions, start, end):
+    lo = entry["pair_offsets"][pairs]
+    hi = entry["pair_offsets"][pairs + 1]
+    if start is None and end is None:
+        return lo, hi
+    keys = entry["keys"]
+    base = pairs.astype(np.int64) * pair_shift + date_offset
+    empty = np.zeros(len(pairs), dtype=bool)
+    if start is not None:
+        start = np.broadcast_to(np.asarray(start), (len(positions),)) if np.ndim(start) == 0 else np.asarray(start)[positions]
+        lo = np.searchsorted(keys, base + start.astype(np.int64), side="left")
+        empty |= start == missing_day
+    if end is not None:
+        end = np.broadcast_to(np.asarray(end), (len(positions),)) if np.ndim(end) == 0 else np.asarray(end)[positions]
+        hi = np.searchsorted(keys, base + end.astype(np.int64), side="right")
+        empty |= end == missing_day
+    # occurrences without a date are never in a window
+    hi = np.minimum(hi, np.searchsorted(keys, base + np.int64(missing_day), side="left"))
+    hi = np.where(empty, lo, np.maximum(hi, lo))
+    return lo, hi
+
+def evaluate_indexed(entry, variable, patient_ids, results):
+    pairs, positions = codelist_pairs(entry, variable["codelist"], patient_ids)
+    start, end = (parse_day(variable.get(limit), results) for limit in ["start", "end"])
+    lo, hi = window_ranges(entry, pairs, positions, start, end)
+    counts = np.bincount(positions, weights=hi - lo, minlength=len(patient_ids)).astype(np.int64)
+    aggregate = variable["aggregate"]
+    if aggregate == "exists":
+        return counts > 0
+    if aggregate == "count":
+        return counts
+    keys = entry["keys"]
+    has = hi > lo
+    pair_base = pairs[has].astype(np.int64) * pair_shift + date_offset
+    if aggregate == "last":
+        days = keys[hi[has] - 1] - pair_base
+        # dates before 1970 are negative days, so no date can serve as "none yet"
+        values = np.full(len(patient_ids), np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(values, positions[has], days)
+        found = np.zeros(len(patient_ids), dtype=bool)
+        found[positions[has]] = True
+        values[~found] = missing_day
+    else:
+        days = keys[lo[has]] - pair_base
+        values = np.full(len(patient_ids), missing_day, dtype=np.int64)
+        np.minimum.at(values, positions[has], days)
+    return values.astype(np.int32)
+
+#######################################################################################
+### EVALUATE: from the index where possible, otherwise on the tables
+#######################################################################################
+def index_entry_name(variable):
+    columns = sorted(variable.get("columns", []))
+    if not columns or variable.get("where"):
+        return None
+    if variable["aggregate"] in ("first", "last") and variable.get("value", event_date_columns[variable["table"]]) != event_date_columns[variable["table"]]:
+        return None
+    for column_name, source_columns in indexed_columns.get(variable["table"], {}).items():
+        if columns == sorted(source_columns) and (len(source_columns) == 1 or variable["aggregate"] != "count"):
+            return f"{variable['table']}/{column_name}"
+    return None
+
+def evaluate_with_index(index, tables, variables, patient_ids):
+    results = {}
+    for name, variable in variables.items():
+        entry_name = index_entry_name(variable)
+        if entry_name in index:
+            results[name] = evaluate_indexed(index[entry_name], variable, patient_ids, results)
+        else:
+            results[name] = evaluate_variable(tables[variable["table"]], variable, patient_ids, results)
+    return results
+
+#######################################################################################
+### RUN
+#######################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", required=True, help="directory with one Arrow/Parquet file per table")
+    parser.add_argument("--index-dir", default="output/code_index")
+    args = parser.parse_args()
+
+    manifest = build_index(args.tables, args.index_dir)
+    for entry_name, entry in manifest["entries"].items():
+        print(f"{entry_name}: {entry['n_codes']} codes, {entry['n_pairs']} (code, patient) pairs, {entry['n_occurrences']} occurrences")
+
+if __name__ == "__main__":
+    main()
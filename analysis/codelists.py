@@ -1,48 +1,96 @@
 #######################################################################################
 # IMPORT
 #######################################################################################
-from ehrql import codelist_from_csv
+import csv
+import sys
+try:
+    from ehrql import codelist_from_csv
+except ImportError:
+    # outside ehrQL (e.g. analysis/local_engine.py) read the csv directly
+    def codelist_from_csv(filename, *, column, category_column=None):
+        with open(filename, newline="") as f:
+            rows = [row for row in csv.DictReader(f) if row[column].strip()]
+        if category_column is None:
+            return list(dict.fromkeys(row[column].strip() for row in rows))
+        return {row[column].strip(): row[category_column].strip() for row in rows}
 
 #######################################################################################
-# Codelists
+# Codelists: name -> (csv file in codelists/, code column, category column)
 #######################################################################################
-# prostate
-prostate_cancer_icd10 = codelist_from_csv("codelists/user-RochelleKnight-prostate_cancer_icd10.csv",column="code")
-prostate_cancer_snomed_clinical = codelist_from_csv("codelists/user-RochelleKnight-prostate_cancer_snomed.csv",column="code")
+codelist_files = {
+    # prostate
+    "prostate_cancer_icd10": ("user-RochelleKnight-prostate_cancer_icd10.csv", "code", None),
+    "prostate_cancer_snomed_clinical": ("user-RochelleKnight-prostate_cancer_snomed.csv", "code", None),
 
-# pregnancy
-pregnancy_snomed_clinical = codelist_from_csv("codelists/user-RochelleKnight-pregnancy_and_birth_snomed.csv",column="code")
+    # pregnancy
+    "pregnancy_snomed_clinical": ("user-RochelleKnight-pregnancy_and_birth_snomed.csv", "code", None),
 
-# combined oral contraceptive pill
-cocp_dmd = codelist_from_csv("codelists/user-elsie_horne-cocp_dmd.csv",column="dmd_id")
+    # combined oral contraceptive pill
+    "cocp_dmd": ("user-elsie_horne-cocp_dmd.csv", "dmd_id", None),
 
-# hormone replacement therapy
-hrt_dmd = codelist_from_csv("codelists/user-elsie_horne-hrt_dmd.csv",column="dmd_id")
+    # hormone replacement therapy
+    "hrt_dmd": ("user-elsie_horne-hrt_dmd.csv", "dmd_id", None),
 
-# ethnicity
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    column="Code",
-    category_column="Grouping_6",
-)
+    # ethnicity
+    "ethnicity_codes": ("opensafely-ethnicity.csv", "Code", "Grouping_6"),
 
-## COVID-19
-covid_primary_care_positive_test = codelist_from_csv("codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv", column="CTV3ID")
-covid_primary_care_code = codelist_from_csv("codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv", column="CTV3ID")
-covid_primary_care_sequelae = codelist_from_csv("codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv", column="CTV3ID")
-covid_codes = codelist_from_csv("codelists/user-RochelleKnight-confirmed-hospitalised-covid-19.csv", column="code") # only PCR-confirmed! => U071 (covid19 virus identified)
+    ## COVID-19
+    "covid_primary_care_positive_test": ("opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv", "CTV3ID", None),
+    "covid_primary_care_code": ("opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv", "CTV3ID", None),
+    "covid_primary_care_sequelae": ("opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv", "CTV3ID", None),
+    "covid_codes": ("user-RochelleKnight-confirmed-hospitalised-covid-19.csv", "code", None), # only PCR-confirmed! => U071 (covid19 virus identified)
 
-# smoking
-smoking_clear = codelist_from_csv("codelists/opensafely-smoking-clear.csv",
-    column="CTV3Code",
-    category_column="Category",
-)
-ever_smoking = codelist_from_csv("codelists/user-alainamstutz-ever-smoking-bristol.csv",column="code")
+    # smoking
+    "smoking_clear": ("opensafely-smoking-clear.csv", "CTV3Code", "Category"),
+    "ever_smoking": ("user-alainamstutz-ever-smoking-bristol.csv", "code", None),
 
-# Patients in long-stay nursing and residential care
-carehome = codelist_from_csv("codelists/primis-covid19-vacc-uptake-longres.csv",column="code")
+    # Patients in long-stay nursing and residential care
+    "carehome": ("primis-covid19-vacc-uptake-longres.csv", "code", None),
 
-### Solid cancer
-non_haematological_cancer_opensafely_snomed_codes_new = codelist_from_csv("codelists/opensafely-cancer-excluding-lung-and-haematological-snomed.csv", column = "id")
-lung_cancer_opensafely_snomed_codes = codelist_from_csv("codelists/opensafely-lung-cancer-snomed.csv", column = "id")
-chemotherapy_radiotherapy_opensafely_snomed_codes = codelist_from_csv("codelists/opensafely-chemotherapy-or-radiotherapy-snomed.csv", column = "id")
\ No newline at end of file
+    ### Solid cancer
+    "non_haematological_cancer_opensafely_snomed_codes_new": ("opensafely-cancer-excluding-lung-and-haematological-snomed.csv", "id", None),
+    "lung_cancer_opensafely_snomed_codes": ("opensafely-lung-cancer-snomed.csv", "id", None),
+    "chemotherapy_radiotherapy_opensafely_snomed_codes": ("opensafely-chemotherapy-or-radiotherapy-snomed.csv", "id", None),
+}
+
+#######################################################################################
+# Composite codelists: name -> the codelists above whose union it is
+#######################################################################################
+# Built once on first use: deduplicated and sorted, so every query using it sends the
+# same single code set instead of concatenating (and repeating) the component lists.
+composite_codelists = {
+    ### Solid cancer
+    "solid_cancer_snomed_codes": [
+        "non_haematological_cancer_opensafely_snomed_codes_new",
+        "lung_cancer_opensafely_snomed_codes",
+        "chemotherapy_radiotherapy_opensafely_snomed_codes",
+    ],
+}
+__all__ = list(codelist_files) + list(composite_codelists)
+
+#######################################################################################
+# Lazy loading: each codelist is parsed from its csv on first use
+#######################################################################################
+def load_codelist(name):
+    filename, column, category_column = codelist_files[name]
+    codelist = codelist_from_csv(f"codelists/{filename}", column=column, category_column=category_column)
+    if category_column is None:
+        return [sys.intern(code) for code in codelist]
+    return {sys.intern(code): sys.intern(category) for code, category in codelist.items()}
+
+def load_composite_codelist(name):
+    codes = set()
+    for component in composite_codelists[name]:
+        codes.update(__getattr__(component))
+    return sorted(codes)
+
+# codelists are only loaded on first attribute access (PEP 562)
+def __getattr__(name):
+    if name in composite_codelists:
+        codelist = load_composite_codelist(name)
+    elif name in codelist_files:
+        codelist = load_codelist(name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = codelist
+    return codelist
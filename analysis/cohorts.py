@@ -0,0 +1,49 @@
+#######################################################################################
+# COHORT matrix: setting x study window x minimum age
+#######################################################################################
+# Used by dataset_definition.py (-- --cohorts) to add, in the same run, each cohort's
+# exposure date and membership flag, and by analysis/split_cohorts.py to write one
+# dataset per cohort.
+#
+# Cost per extra cohort: helper queries are only shared between cohorts with the same
+# index date (setting and window), as the index date is part of the helper cache key.
+# - a cohort with a new setting or window: one more exposure-date query, plus a full
+#   separate set of the index-date covariates and outcomes (variables_at() in
+#   dataset_definition.py)
+# - a cohort that only adds a minimum age to an existing index date: its membership
+#   flag only (age at the exposure date), no further event-table queries
+# The matrix below has 6 index dates, so -- --cohorts adds 5 sets of index-date
+# queries to the main extraction (hosp_study is the main index date).
+import itertools
+import json
+
+with open("output/study_dates.json") as f:
+  study_dates = json.load(f)
+studyend_date = study_dates["studyend_date"]
+studystart_date = study_dates["studystart_date"]
+
+## covid_indication of the baricitinib treatment
+settings = {
+    "hosp": "hospitalised_with",
+    "hosp_onset": "hospital_onset",
+}
+## study windows: first treatment on or between these dates
+windows = {
+    "study": (studystart_date, studyend_date),
+    "to_2021": (studystart_date, "2021-12-31"),
+    "from_2022": ("2022-01-01", studyend_date),
+}
+## minimum age at the first treatment in the window
+min_ages = [18, 65]
+
+## index dates: one per setting and window, "hosp_study" is exp_date_bari_hosp_first
+index_dates = {
+    f"{setting}_{window}": (settings[setting], *windows[window])
+    for setting, window in itertools.product(settings, windows)
+}
+primary_index = "hosp_study"
+
+cohorts = {
+    f"{setting}_{window}_age{min_age}": {"index": f"{setting}_{window}", "min_age": min_age}
+    for setting, window, min_age in itertools.product(settings, windows, min_ages)
+}
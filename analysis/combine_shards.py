@@ -0,0 +1,59 @@
+################################################################################
+## This script does the following:
+# 1. Import the per-shard extractions (output/shards/dataset_shard_<i>.arrow, from
+#    the generate_dataset_shard_<i> actions, i.e. `-- --shard i --shards n`)
+# 2. Check that all shards are present, share one schema and are disjoint (not on
+#    dummy data: each shard action generates its own dummy patients, numbered from 1,
+#    so dummy shards always overlap)
+# 3. Save their record batches, unchanged and in shard order, as one Arrow file:
+#    the shards are memory-mapped and their batches written out as they are, so no
+#    column is copied or converted on the way
+################################################################################
+import argparse
+import os
+
+import numpy as np
+import pyarrow as pa
+
+from arrow_helper_functions import read_arrow
+
+################################################################################
+# 1 Combine
+################################################################################
+def combine_shards(shards, check_disjoint=True):
+    schema = shards[0].schema
+    for i, shard in enumerate(shards):
+        if not shard.schema.equals(schema):
+            raise ValueError(f"shard {i} has a different schema from shard 0")
+    patient_ids = np.concatenate([shard.column("patient_id").to_numpy() for shard in shards])
+    if len(np.unique(patient_ids)) != len(patient_ids):
+        if check_disjoint:
+            raise ValueError("shards overlap: a patient is in more than one shard")
+        print("shards overlap (expected on dummy data, not checked)")
+    return pa.concat_tables(shards)
+
+def write_batches(table, path):
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            for batch in table.to_batches():
+                writer.write_batch(batch)
+
+################################################################################
+# 2 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--input-dir", default="output/shards")
+    parser.add_argument("--output", default="output/dataset_sharded.arrow")
+    args = parser.parse_args()
+
+    shards = [read_arrow(f"{args.input_dir}/dataset_shard_{i}.arrow") for i in range(args.shards)]
+    # OPENSAFELY_BACKEND is "expectations" when the actions run on dummy data
+    dummy_data = os.environ.get("OPENSAFELY_BACKEND") == "expectations"
+    combined = combine_shards(shards, check_disjoint=not dummy_data)
+    write_batches(combined, args.output)
+    print(f"combined {args.shards} shards: {', '.join(str(shard.num_rows) for shard in shards)} patients")
+
+if __name__ == "__main__":
+    main()
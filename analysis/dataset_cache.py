@@ -0,0 +1,129 @@
+################################################################################
+## This script does the following:
+# 1. Load analysis/dataset_definition.py (as analysis/query_report.py does) and key
+#    every variable by a hash of its normalised query graph, the population's query
+#    graph and the contents of the --dummy-tables it is extracted from. The graph
+#    holds the codes of the codelists the variable uses and the study dates, so a
+#    variable's key only changes with its own codelists
+# 2. Reuse the cached column of every variable whose key is in output/dataset_cache/
+# 3. Extract only the other variables, with one ehrQL run of the definition limited
+#    to them (-- --variables ...), and add their columns to the cache
+# 4. Assemble all columns by patient_id, in definition order, into the dataset
+#
+# Changing one covariate only re-extracts that column; if nothing in the keys changed
+# no extraction runs at all. Only for fixed input tables: without --dummy-tables ehrQL
+# generates a new random population on every run, so cached and newly extracted
+# columns would describe different patients. Needs ehrQL installed (e.g. the codespace):
+#   python analysis/dataset_cache.py --dummy-tables <dir>
+################################################################################
+import argparse
+import dataclasses
+import hashlib
+import json
+import shlex
+import subprocess
+import tempfile
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from ehrql.query_model.nodes import Node
+
+from arrow_helper_functions import (
+    read_arrow,
+    write_arrow,
+)
+from query_report import load_variables
+
+################################################################################
+# 1 Keys: normalised query graph (code sets sorted, so the key does not depend on
+#   Python's hash seed) plus the input tables, which the graph does not capture
+################################################################################
+def normalise(value, memo):
+    if isinstance(value, Node):
+        if value not in memo:
+            fields = tuple((field.name, normalise(getattr(value, field.name), memo)) for field in dataclasses.fields(value))
+            memo[value] = repr((type(value).__qualname__, fields))
+        return memo[value]
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(normalise(item, memo) for item in value))
+    if isinstance(value, (tuple, list)):
+        return repr([normalise(item, memo) for item in value])
+    if isinstance(value, dict):
+        return repr(sorted((repr(key), normalise(item, memo)) for key, item in value.items()))
+    return repr(value)
+
+def tables_hash(tables_dir):
+    digest = hashlib.sha256()
+    for path in sorted(path for path in Path(tables_dir).rglob("*") if path.is_file()):
+        digest.update(str(path.relative_to(tables_dir)).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def variable_keys(variables, tables_dir):
+    memo = {}
+    shared = normalise(variables["population"]["node"], memo) + tables_hash(tables_dir)
+    return {
+        name: hashlib.sha256((shared + normalise(variable["node"], memo)).encode()).hexdigest()
+        for name, variable in variables.items()
+        if name != "population"
+    }
+
+################################################################################
+# 2 Extract the variables missing from the cache
+################################################################################
+def extract(command, definition, names, dummy_tables):
+    with tempfile.TemporaryDirectory() as output_dir:
+        output = f"{output_dir}/dataset.arrow"
+        args = [*shlex.split(command), definition, "--output", output, "--dummy-tables", dummy_tables]
+        subprocess.run([*args, "--", "--variables", *names], check=True)
+        return read_arrow(output)
+
+################################################################################
+# 3 Assemble the cached columns by patient_id
+################################################################################
+def assemble(columns):
+    patient_ids = pc.unique(pa.chunked_array([column.column("patient_id") for column in columns.values()]))
+    patient_ids = pc.take(patient_ids, pc.sort_indices(patient_ids))
+    assembled = {"patient_id": patient_ids}
+    for name, column in columns.items():
+        rows = pc.index_in(patient_ids, value_set=column.column("patient_id"))
+        assembled[name] = column.column("value").take(rows)
+    return pa.table(assembled)
+
+################################################################################
+# 4 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--definition", default="analysis/dataset_definition.py")
+    parser.add_argument("--output", default="output/dataset_cached.arrow", help="not output/dataset.arrow, which the real extraction writes")
+    parser.add_argument("--cache-dir", default="output/dataset_cache")
+    parser.add_argument("--dummy-tables", required=True, help="directory of dummy tables passed on to generate-dataset (part of every key)")
+    parser.add_argument("--command", default="ehrql generate-dataset", help="command running generate-dataset")
+    args = parser.parse_args()
+
+    variables, _ = load_variables(args.definition)
+    keys = variable_keys(variables, args.dummy_tables)
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    missing = [name for name, key in keys.items() if not (cache_dir / f"{key}.arrow").exists()]
+    if missing:
+        extracted = extract(args.command, args.definition, missing, args.dummy_tables)
+        for name in missing:
+            # stored as "value", so renaming a variable does not invalidate its column
+            column = extracted.select(["patient_id", name]).rename_columns(["patient_id", "value"])
+            write_arrow(column, cache_dir / f"{keys[name]}.arrow")
+
+    columns = {name: read_arrow(cache_dir / f"{key}.arrow") for name, key in keys.items()}
+    write_arrow(assemble(columns), args.output)
+    with open(cache_dir / "manifest.json", "w") as f:
+        json.dump(keys, f, indent=2)
+    print(f"{len(keys) - len(missing)} variables from the cache, {len(missing)} extracted")
+
+if __name__ == "__main__":
+    main()
@@ -19,18 +19,33 @@ from ehrql.tables.tpp import (
     ons_deaths,
     medications,
     apcs,
-    addresses,
+    covid_therapeutics,
     practice_registrations
 )
 
-## Import all codelists from codelists.py
-from codelists import *
+## Import the codelists used below from codelists.py (each one is loaded lazily, on first use)
+from codelists import (
+    prostate_cancer_icd10,
+    prostate_cancer_snomed_clinical,
+    pregnancy_snomed_clinical,
+    cocp_dmd,
+    hrt_dmd,
+    ethnicity_codes,
+    smoking_clear,
+    ever_smoking,
+    carehome,
+    solid_cancer_snomed_codes,
+    covid_codes
+)
 
 ## Import the variable helper functions 
 from variable_helper_functions import *
+clear_helper_cache() # the module (and its cache) outlives a previous load in the same process
 
-## json (for the dates)
+## json (for the dates), argparse (for the parameters passed after `--` in project.yaml)
+import argparse
 import json
+import sys
 
 #######################################################################################
 # IMPORT the dates
@@ -40,52 +55,113 @@ with open("output/study_dates.json") as f:
 studyend_date = study_dates["studyend_date"]
 studystart_date = study_dates["studystart_date"]
 
+#######################################################################################
+# PARAMETERS
+#######################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--since-watermark", help="incremental run: watermark JSON of the previous dataset (analysis/incremental_dataset.py), whose studyend_date the increment starts after")
+parser.add_argument("--shard", type=int, default=0, help="sharded run: this shard (0 .. shards - 1)")
+parser.add_argument("--shards", type=int, default=1, help="sharded run: number of shards")
+parser.add_argument("--cohorts", action="store_true", help="add the exposure dates, flags and index-date variables of the cohorts in analysis/cohorts.py")
+parser.add_argument("--variables", nargs="*", help="only these variables (for the result cache, analysis/dataset_cache.py)")
+parser.add_argument("--ranks", type=int, default=0, help="only the 1st..Nth treatment date of both settings (for analysis/bari_episodes.py), as its own dataset")
+parser.add_argument("--cache-report", action="store_true", help="show the repeated helper calls reused through the helper cache in the job log")
+parser.add_argument("--index-dates", nargs="*", default=[], choices=["second", "third", "onset_first"], help="also evaluate the index-date variables at these exposure dates")
+args = parser.parse_args()
+args.since = None
+if args.since_watermark:
+    with open(args.since_watermark) as f:
+        args.since = json.load(f)["studyend_date"]
+
 #######################################################################################
 # INITIALISE the dataset and set the dummy dataset size
 #######################################################################################
 dataset = create_dataset()
 dataset.configure_dummy_data(population_size=10000)
-dataset.define_population(patients.exists_for_patient())
 
 #######################################################################################
 #  Define the exposure start
 #######################################################################################
+## Baricitinib treatments at hospital admission after pandemic start, ranked by treatment
+## date: only the 1st..3rd, the ranks used below (each rank is one more dependent query)
+bari_hosp_ranked = ranked_matching_events_bari_between("hospitalised_with", studystart_date, studyend_date, 3)
+
 ## First baricitinib treatment, at hospital admission, after pandemic start
-dataset.exp_date_bari_hosp_first = first_matching_event_bari_between("hospitalised_with", studystart_date, studyend_date).treatment_start_date 
+bari_hosp_first = bari_hosp_ranked[0]
+dataset.exp_date_bari_hosp_first = bari_hosp_first.treatment_start_date 
 
 ## First baricitinib treatment, BUT hospital onset, after pandemic start (look into this in a second step)
-dataset.exp_date_bari_hosp_onset_first = first_matching_event_bari_between("hospital_onset", studystart_date, studyend_date).treatment_start_date 
+bari_hosp_onset_first = first_matching_event_bari_between("hospital_onset", studystart_date, studyend_date)
+dataset.exp_date_bari_hosp_onset_first = bari_hosp_onset_first.treatment_start_date 
+
+#######################################################################################
+#  Define the population: cohort-first, two-stage extraction
+#######################################################################################
+## Stage 1: only patients with a baricitinib treatment (either setting) in the study period
+bari_exposed = bari_hosp_first.exists_for_patient() | bari_hosp_onset_first.exists_for_patient()
+## Incremental run (--since-watermark): only the patients with rows dated after the previous end date,
+## in the tables and codelists whose values can change with follow-up; merged into the
+## previous output/dataset.arrow by analysis/incremental_dataset.py
+if args.since:
+    bari_exposed = bari_exposed & any_of([
+        covid_therapeutics.where(covid_therapeutics.intervention.is_in(["Baricitinib"]))
+        .where(covid_therapeutics.treatment_start_date.is_after(args.since)).exists_for_patient(),
+        apcs.where(apcs.admission_date.is_after(args.since))
+        .where(any_of([
+            apcs.primary_diagnosis.is_in(covid_codes) | apcs.secondary_diagnosis.is_in(covid_codes), # out_date_covid_hosp
+            apcs.all_diagnoses.contains_any_of(prostate_cancer_icd10) # qa_bin_prostate_cancer
+        ])).exists_for_patient(),
+        ons_deaths.date.is_after(args.since),
+        clinical_events.where(clinical_events.date.is_after(args.since))
+        .where(any_of([
+            clinical_events.snomedct_code.is_in(pregnancy_snomed_clinical),
+            clinical_events.snomedct_code.is_in(prostate_cancer_snomed_clinical),
+            clinical_events.ctv3_code.is_in(ethnicity_codes)
+        ])).exists_for_patient(),
+        medications.where(medications.date.is_after(args.since))
+        .where(medications.dmd_code.is_in(cocp_dmd) | medications.dmd_code.is_in(hrt_dmd)).exists_for_patient()
+    ])
+## Sharded run (--shard i --shards n): patients split into n disjoint shards, extracted by
+## parallel actions and concatenated by analysis/combine_shards.py. ehrQL does not expose
+## patient_id, so the shards are buckets of the month of birth (missing: shard 0).
+## The filter only narrows the population: each shard still runs every query over the
+## full tables, so n shards are about n times the scan load of one extraction on the
+## backend, not 1/n each. Not measured on the backend.
+if args.shards > 1:
+    birth_month = patients.date_of_birth.year * 12 + patients.date_of_birth.month
+    in_shard = (birth_month - (birth_month // args.shards) * args.shards) == args.shard
+    if args.shard == 0:
+        in_shard = in_shard | patients.date_of_birth.is_null()
+    bari_exposed = bari_exposed & in_shard
+dataset.define_population(bari_exposed)
+## Stage 2: every further helper call is passed cohort=bari_exposed, so it only scans the rows
+## of these patients
 
 index_date = dataset.exp_date_bari_hosp_first
 
-# second and third exposure dates
-dataset.exp_date_bari_hosp_second = first_matching_event_bari_between("hospitalised_with", index_date, studyend_date).treatment_start_date 
-second_date = dataset.exp_date_bari_hosp_second
-dataset.exp_date_bari_hosp_third = first_matching_event_bari_between("hospitalised_with", second_date, studyend_date).treatment_start_date
+# second and third exposure dates (each strictly after the previous one)
+dataset.exp_date_bari_hosp_second = bari_hosp_ranked[1].treatment_start_date 
+dataset.exp_date_bari_hosp_third = bari_hosp_ranked[2].treatment_start_date
 
 #######################################################################################
 #  QUALITY ASSURANCE variables
 #######################################################################################
 ### demographic QA
 dataset.qa_bin_is_female_or_male = patients.sex.is_in(["female", "male"]) 
-dataset.qa_bin_was_adult = (patients.age_on(index_date) >= 18) & (patients.age_on(index_date) <= 110) 
-dataset.qa_bin_was_alive = patients.is_alive_on(index_date)
-dataset.qa_bin_known_imd = addresses.for_patient_on(index_date).exists_for_patient() # known deprivation
-dataset.qa_bin_was_registered = practice_registrations.spanning(index_date - days(366), index_date).exists_for_patient() # see https://docs.opensafely.org/ehrql/reference/schemas/tpp/#practice_registrations.spanning. Calculated from 1 year = 365.25 days, taking into account leap year.
 dataset.qa_num_birth_year = patients.date_of_birth
 dataset.qa_date_of_death = ons_deaths.date
 ### clinical QA
 ## Pregnancy (over entire study period)
-dataset.qa_bin_pregnancy = clinical_events.where(clinical_events.snomedct_code.is_in(pregnancy_snomed_clinical)).exists_for_patient()
+dataset.qa_bin_pregnancy = in_cohort(clinical_events, bari_exposed).where(clinical_events.snomedct_code.is_in(pregnancy_snomed_clinical)).exists_for_patient()
 ## Combined oral contraceptive pill (over entire study period)
-dataset.qa_bin_cocp = medications.where(medications.dmd_code.is_in(cocp_dmd)).exists_for_patient()
+dataset.qa_bin_cocp = in_cohort(medications, bari_exposed).where(medications.dmd_code.is_in(cocp_dmd)).exists_for_patient()
 ## Hormone replacement therapy (over entire study period)
-dataset.qa_bin_hrt = medications.where(medications.dmd_code.is_in(hrt_dmd)).exists_for_patient()
+dataset.qa_bin_hrt = in_cohort(medications, bari_exposed).where(medications.dmd_code.is_in(hrt_dmd)).exists_for_patient()
 ## Prostate cancer (over entire study period)
 ### Primary care
-prostate_cancer_snomed = clinical_events.where(clinical_events.snomedct_code.is_in(prostate_cancer_snomed_clinical)).exists_for_patient()
+prostate_cancer_snomed = in_cohort(clinical_events, bari_exposed).where(clinical_events.snomedct_code.is_in(prostate_cancer_snomed_clinical)).exists_for_patient()
 ### HES APC
-prostate_cancer_hes = apcs.where(apcs.all_diagnoses.contains_any_of(prostate_cancer_icd10)).exists_for_patient()
+prostate_cancer_hes = in_cohort(apcs, bari_exposed).where(apcs.all_diagnoses.contains_any_of(prostate_cancer_icd10)).exists_for_patient()
 ### ONS (stated anywhere on death certificate)
 prostate_cancer_death = cause_of_death_matches(prostate_cancer_icd10)
 # Combined: Any prostate cancer diagnosis
@@ -101,60 +177,154 @@ dataset.qa_bin_prostate_cancer = case(
 #######################################################################################
 # Sex
 dataset.cov_cat_sex = patients.sex
-## Age at index_date
-dataset.cov_num_age = patients.age_on(index_date)
 # Ethnicity in 6 categories
 dataset.ethnicity_cat = (
-    clinical_events.where(clinical_events.ctv3_code.is_in(ethnicity_codes))
+    in_cohort(clinical_events, bari_exposed).where(clinical_events.ctv3_code.is_in(ethnicity_codes))
     .sort_by(clinical_events.date)
     .last_for_patient()
     .ctv3_code.to_category(ethnicity_codes))
-## Index of Multiple Deprevation Rank (rounded down to nearest 100). 5 categories.
-imd_rounded = addresses.for_patient_on(index_date).imd_rounded
-dataset.cov_cat_deprivation_5 = case(
-    when((imd_rounded >=0) & (imd_rounded < int(32844 * 1 / 5))).then("1 (most deprived)"),
-    when(imd_rounded < int(32844 * 2 / 5)).then("2"),
-    when(imd_rounded < int(32844 * 3 / 5)).then("3"),
-    when(imd_rounded < int(32844 * 4 / 5)).then("4"),
-    when(imd_rounded < int(32844 * 5 / 5)).then("5 (least deprived)"),
-    otherwise="unknown")
-## Practice registration info at index_date and derived region, STP and rural/urban
-registered = practice_registrations.for_patient_on(index_date)
-dataset.cov_cat_region = registered.practice_nuts1_region_name ## Region
-dataset.cov_cat_stp = registered.practice_stp ## Practice
-dataset.cov_cat_rural_urban = addresses.for_patient_on(index_date).rural_urban_classification ## Rurality
-## Smoking status at index_date
-tmp_most_recent_smoking_cat = last_matching_event_clinical_ctv3_before(smoking_clear, index_date).ctv3_code.to_category(smoking_clear)
-tmp_ever_smoked = last_matching_event_clinical_ctv3_before(ever_smoking, index_date).exists_for_patient() # uses a different codelist with ONLY smoking codes
-dataset.cov_cat_smoking_status = case(
-    when(tmp_most_recent_smoking_cat == "S").then("S"),
-    when(tmp_most_recent_smoking_cat == "E").then("E"),
-    when((tmp_most_recent_smoking_cat == "N") & (tmp_ever_smoked == True)).then("E"),
-    when(tmp_most_recent_smoking_cat == "N").then("N"),
-    when((tmp_most_recent_smoking_cat == "M") & (tmp_ever_smoked == True)).then("E"),
-    when(tmp_most_recent_smoking_cat == "M").then("M"),
-    otherwise = "M")
-## Care home resident at index_date, see https://github.com/opensafely/opioids-covid-research/blob/main/analysis/define_dataset_table.py
-# Flag care home based on primis (patients in long-stay nursing and residential care)
-tmp_care_home_code = last_matching_event_clinical_snomed_before(carehome, index_date).exists_for_patient()
-# Flag care home based on TPP
-tmp_care_home_tpp1 = addresses.for_patient_on(index_date).care_home_is_potential_match
-tmp_care_home_tpp2 = addresses.for_patient_on(index_date).care_home_requires_nursing
-tmp_care_home_tpp3 = addresses.for_patient_on(index_date).care_home_does_not_require_nursing
-# combine
-dataset.cov_bin_carehome_status = case(
-    when(tmp_care_home_code).then(True),
-    when(tmp_care_home_tpp1).then(True),
-    when(tmp_care_home_tpp2).then(True),
-    when(tmp_care_home_tpp3).then(True),
-    otherwise = False)
 ## Treatment status at first hosp treatment with bari
-dataset.cov_status_bari_hosp_first = first_matching_event_bari_between("hospitalised_with", studystart_date, studyend_date).current_status 
+dataset.cov_status_bari_hosp_first = bari_hosp_first.current_status 
+
+#######################################################################################
+# Variables at an index date: QA at index, the index-date dependent covariates and the
+# outcomes after index_date
+#######################################################################################
+## Evaluated at index_date (exp_date_bari_hosp_first) with the names below, and for the
+## sensitivity analyses with --index-dates at the other exposure dates, as extra columns
+## suffixed with the index date (e.g. cov_num_age_second). The index date is part of
+## the helper cache key, so nothing is shared between index dates: each extra index
+## date adds a full separate set of the queries below.
+other_index_dates = {
+    "second": dataset.exp_date_bari_hosp_second,
+    "third": dataset.exp_date_bari_hosp_third,
+    "onset_first": dataset.exp_date_bari_hosp_onset_first,
+}
+def variables_at(index_date):
+    variables = {}
+    ## Active address and practice registration on index_date: each is looked up once, and
+    ## the QA variables and covariates below read their columns from these snapshots
+    ## (except qa_bin_was_registered: any registration spanning the whole year before)
+    address = address_snapshot_on(index_date, cohort=bari_exposed)
+    registered = registration_snapshot_on(index_date, cohort=bari_exposed)
+
+    ### demographic QA at index_date
+    variables["qa_bin_was_adult"] = (patients.age_on(index_date) >= 18) & (patients.age_on(index_date) <= 110) 
+    variables["qa_bin_was_alive"] = patients.is_alive_on(index_date)
+    variables["qa_bin_known_imd"] = address.exists_for_patient() # known deprivation
+    variables["qa_bin_was_registered"] = in_cohort(practice_registrations, bari_exposed).spanning(index_date - days(366), index_date).exists_for_patient() # see https://docs.opensafely.org/ehrql/reference/schemas/tpp/#practice_registrations.spanning. Calculated from 1 year = 365.25 days, taking into account leap year.
+    ## Age at index_date
+    variables["cov_num_age"] = patients.age_on(index_date)
+    ## Index of Multiple Deprevation Rank (rounded down to nearest 100). 5 categories.
+    imd_rounded = address.imd_rounded
+    variables["cov_cat_deprivation_5"] = case(
+        when((imd_rounded >=0) & (imd_rounded < int(32844 * 1 / 5))).then("1 (most deprived)"),
+        when(imd_rounded < int(32844 * 2 / 5)).then("2"),
+        when(imd_rounded < int(32844 * 3 / 5)).then("3"),
+        when(imd_rounded < int(32844 * 4 / 5)).then("4"),
+        when(imd_rounded < int(32844 * 5 / 5)).then("5 (least deprived)"),
+        otherwise="unknown")
+    ## Practice registration info at index_date and derived region, STP and rural/urban
+    variables["cov_cat_region"] = registered.practice_nuts1_region_name ## Region
+    variables["cov_cat_stp"] = registered.practice_stp ## Practice
+    variables["cov_cat_rural_urban"] = address.rural_urban_classification ## Rurality
+    ## Smoking status at index_date
+    tmp_most_recent_smoking_cat = last_matching_event_clinical_ctv3_before(smoking_clear, index_date, cohort=bari_exposed).ctv3_code.to_category(smoking_clear)
+    tmp_ever_smoked = last_matching_event_clinical_ctv3_before(ever_smoking, index_date, cohort=bari_exposed).exists_for_patient() # uses a different codelist with ONLY smoking codes
+    variables["cov_cat_smoking_status"] = case(
+        when(tmp_most_recent_smoking_cat == "S").then("S"),
+        when(tmp_most_recent_smoking_cat == "E").then("E"),
+        when((tmp_most_recent_smoking_cat == "N") & (tmp_ever_smoked == True)).then("E"),
+        when(tmp_most_recent_smoking_cat == "N").then("N"),
+        when((tmp_most_recent_smoking_cat == "M") & (tmp_ever_smoked == True)).then("E"),
+        when(tmp_most_recent_smoking_cat == "M").then("M"),
+        otherwise = "M")
+    ## Care home resident at index_date, see https://github.com/opensafely/opioids-covid-research/blob/main/analysis/define_dataset_table.py
+    # Flag care home based on primis (patients in long-stay nursing and residential care)
+    tmp_care_home_code = last_matching_event_clinical_snomed_before(carehome, index_date, cohort=bari_exposed).exists_for_patient()
+    # Flag care home based on TPP
+    tmp_care_home_tpp1 = address.care_home_is_potential_match
+    tmp_care_home_tpp2 = address.care_home_requires_nursing
+    tmp_care_home_tpp3 = address.care_home_does_not_require_nursing
+    # combine
+    variables["cov_bin_carehome_status"] = case(
+        when(tmp_care_home_code).then(True),
+        when(tmp_care_home_tpp1).then(True),
+        when(tmp_care_home_tpp2).then(True),
+        when(tmp_care_home_tpp3).then(True),
+        otherwise = False)
+
+    ## Comorbidities ##
+    ## Solid cancer
+    solid_cancer = matching_event_clinical_snomed_windows(solid_cancer_snomed_codes, index_date, [180, "ever"], cohort=bari_exposed)
+    variables["cov_solid_cancer_new"] = solid_cancer[180]["exists"]
+    variables["cov_solid_cancer_ever"] = solid_cancer["ever"]["exists"]
 
-## Comorbidities ##
-## Solid cancer
-dataset.cov_solid_cancer_new = last_matching_event_clinical_snomed_between(non_haematological_cancer_opensafely_snomed_codes_new + lung_cancer_opensafely_snomed_codes + chemotherapy_radiotherapy_opensafely_snomed_codes, index_date - days(180), index_date).exists_for_patient()
-dataset.cov_solid_cancer_ever = last_matching_event_clinical_snomed_before(non_haematological_cancer_opensafely_snomed_codes_new + lung_cancer_opensafely_snomed_codes + chemotherapy_radiotherapy_opensafely_snomed_codes, index_date).exists_for_patient()
+    ## Outcomes after index_date, for the follow-up and person-time stage (analysis/person_time.py)
+    ## COVID-19 hospital admission (primary or secondary diagnosis), from the day after index_date
+    variables["out_date_covid_hosp"] = first_matching_event_apc_between(covid_codes, index_date + days(1), studyend_date, cohort=bari_exposed).admission_date
+    ## COVID-19 death (anywhere on the death certificate), on or after index_date
+    variables["out_date_covid_death"] = case(when(matching_death_between(covid_codes, index_date, studyend_date)).then(ons_deaths.date))
+    return variables
+
+for name, value in variables_at(index_date).items():
+    setattr(dataset, name, value)
+for label in args.index_dates:
+    for name, value in variables_at(other_index_dates[label]).items():
+        setattr(dataset, f"{name}_{label}", value)
+
+#######################################################################################
+# COHORT matrix (--cohorts): setting x study window x minimum age, see analysis/cohorts.py
+#######################################################################################
+## Per index date (setting and window) the first treatment date, exp_date_bari_<index>, and
+## the index-date variables suffixed with the index (the primary index has them unsuffixed);
+## per cohort a flag cohort_bin_<cohort>. analysis/split_cohorts.py writes one dataset per cohort.
+if args.cohorts:
+    from cohorts import cohorts, index_dates, primary_index
+    exposures = {}
+    for index, (setting, start_date, end_date) in index_dates.items():
+        exposures[index] = first_matching_event_bari_between(setting, start_date, end_date, cohort=bari_exposed).treatment_start_date
+        setattr(dataset, f"exp_date_bari_{index}", exposures[index])
+        if index != primary_index:
+            for name, value in variables_at(exposures[index]).items():
+                setattr(dataset, f"{name}_{index}", value)
+    for name, cohort in cohorts.items():
+        exposure = exposures[cohort["index"]]
+        setattr(dataset, f"cohort_bin_{name}", (exposure.is_not_null() & (patients.age_on(exposure) >= cohort["min_age"])).when_null_then(False))
+
+#######################################################################################
+# RANKED treatment dates (--ranks N): a dataset of their own, output/dataset_ranks.arrow
+#######################################################################################
+## The 1st..Nth treatment date of both settings, collapsed into treatment episodes by
+## analysis/bari_episodes.py, whose next episode ends follow-up in analysis/person_time.py.
+## Every rank is one more dependent query, so they are not part of the main extraction.
+if args.ranks:
+    ranks = create_dataset()
+    ranks.configure_dummy_data(population_size=10000)
+    ranks.define_population(bari_exposed)
+    for setting, prefix in [("hospitalised_with", "exp_date_bari_hosp_rank_"), ("hospital_onset", "exp_date_bari_hosp_onset_rank_")]:
+        ranked = ranked_matching_events_bari_between(setting, studystart_date, studyend_date, args.ranks, cohort=bari_exposed)
+        for k in range(args.ranks):
+            setattr(ranks, f"{prefix}{k + 1:02d}", ranked[k].treatment_start_date)
+    dataset = ranks
+
+#######################################################################################
+# SUBSET of the variables (--variables): the ones missing from the result cache
+#######################################################################################
+if args.variables:
+    subset = create_dataset()
+    subset.configure_dummy_data(population_size=10000)
+    subset.define_population(bari_exposed)
+    for name in args.variables:
+        setattr(subset, name, getattr(dataset, name))
+    dataset = subset
+
+#######################################################################################
+# Report the repeated helper calls reused through the helper cache (--cache-report, in the
+# job log); ehrQL dedupes identical queries itself, so the queries are the same without it
+#######################################################################################
+if args.cache_report:
+    print(helper_cache_report(), file=sys.stderr)
 
 
 
@@ -0,0 +1,324 @@
+################################################################################
+## This script does the following:
+# 1. Generate a synthetic, TPP-shaped population of any size in batches of patients
+#    (bounded memory), using the actual codelists from codelists.py and the study
+#    dates from output/study_dates.json, so that baricitinib exposure, covariate
+#    codes and follow-up line up
+# 2. Stream each table to output/dummy_tables/<table>.arrow as Arrow record batches
+#
+# Every table has all the columns of its ehrQL TPP table (see schemas below), so the
+# tables are ehrQL dummy tables (--dummy-tables) for the real dataset definition, and
+# through it for type_dataset.py and data_process.R; analysis/local_engine.py reads
+# them too. Columns the study does not use are null. See "Performance testing on dummy tables" in
+# README.md:
+#   python analysis/dummy_data.py --population-size 1000000
+#   opensafely exec ehrql:v1 generate-dataset analysis/dataset_definition.py \
+#       --dummy-tables output/dummy_tables --output output/dataset.arrow
+################################################################################
+import argparse
+import datetime
+import json
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import codelists
+
+################################################################################
+# 0 Settings
+################################################################################
+# Codelist events per table: (codelist name in codelists.py, code column, share of
+# patients with any event, mean number of events for those patients, sex or None)
+event_codelists = {
+    "clinical_events": [
+        ("ethnicity_codes", "ctv3_code", 0.80, 1, None),
+        ("smoking_clear", "ctv3_code", 0.60, 3, None),
+        ("ever_smoking", "ctv3_code", 0.30, 2, None),
+        ("carehome", "snomedct_code", 0.02, 1, None),
+        ("pregnancy_snomed_clinical", "snomedct_code", 0.05, 2, "female"),
+        ("prostate_cancer_snomed_clinical", "snomedct_code", 0.02, 3, "male"),
+        ("non_haematological_cancer_opensafely_snomed_codes_new", "snomedct_code", 0.05, 3, None),
+        ("lung_cancer_opensafely_snomed_codes", "snomedct_code", 0.01, 3, None),
+        ("chemotherapy_radiotherapy_opensafely_snomed_codes", "snomedct_code", 0.02, 4, None),
+    ],
+    "medications": [
+        ("cocp_dmd", "dmd_code", 0.10, 5, "female"),
+        ("hrt_dmd", "dmd_code", 0.05, 5, "female"),
+    ],
+    "apcs": [
+        ("prostate_cancer_icd10", "primary_diagnosis", 0.005, 1, "male"),
+    ],
+    "opa_diag": [],
+    "emergency_care_attendances": [],
+}
+# mean number of non-matching events per patient, per table (the bulk of the rows)
+background_events = {"clinical_events": 20, "medications": 10, "apcs": 0.5, "opa_diag": 2, "emergency_care_attendances": 1}
+# code column of the background events per table, with codes shaped like that column's
+# codes: SNOMED CT / dm+d style numeric ids, ICD-10 symptom codes (R00-R699) for the
+# hospital diagnoses; codes of the codelists used for the column are left out
+background_columns = {
+    "clinical_events": "snomedct_code",
+    "medications": "dmd_code",
+    "apcs": "primary_diagnosis",
+    "opa_diag": "primary_diagnosis_code",
+    "emergency_care_attendances": "diagnosis_01",
+}
+background_code_shapes = {
+    "snomedct_code": [f"999{i:07d}" for i in range(1000)],
+    "dmd_code": [f"999{i:07d}" for i in range(1000)],
+    "primary_diagnosis": [f"R{i:02d}{j}" for i in range(70) for j in range(10)],
+    "primary_diagnosis_code": [f"R{i:02d}{j}" for i in range(70) for j in range(10)],
+    "diagnosis_01": [f"999{i:07d}" for i in range(1000)],
+}
+# date column of each event table
+event_date_columns = {
+    "clinical_events": "date",
+    "medications": "date",
+    "apcs": "admission_date",
+    "opa_diag": "appointment_date",
+    "emergency_care_attendances": "arrival_date",
+}
+bari_settings = ["hospitalised_with", "hospital_onset"]
+bari_statuses = ["Approved", "Treatment Complete", "Treatment Not Started", "Treatment Stopped"]
+regions = ["North East", "North West", "Yorkshire and The Humber", "East Midlands", "West Midlands", "East", "London", "South East", "South West"]
+history_years = 10 # events are drawn from studystart_date - history_years to studyend_date
+
+# the columns and types of the ehrQL TPP tables the dataset definition uses (ehrQL
+# dummy tables must have every column of the table)
+def schema(*columns):
+    return pa.schema([("patient_id", pa.int64()), *columns])
+
+schemas = {
+    "patients": schema(("date_of_birth", pa.date32()), ("sex", pa.string()), ("date_of_death", pa.date32())),
+    "covid_therapeutics": schema(
+        ("covid_indication", pa.string()), ("current_status", pa.string()), ("intervention", pa.string()),
+        ("diagnosis", pa.string()), ("form", pa.string()), ("received", pa.date32()), ("region", pa.string()),
+        ("risk_cohort", pa.string()), ("treatment_start_date", pa.date32()), ("age_at_received", pa.int64()),
+    ),
+    "clinical_events": schema(
+        ("date", pa.date32()), ("snomedct_code", pa.string()), ("ctv3_code", pa.string()),
+        ("numeric_value", pa.float64()), ("consultation_id", pa.int64()),
+    ),
+    "medications": schema(("date", pa.date32()), ("dmd_code", pa.string()), ("consultation_id", pa.int64())),
+    "apcs": schema(
+        ("apcs_ident", pa.int64()), ("admission_date", pa.date32()), ("discharge_date", pa.date32()),
+        ("admission_method", pa.string()), ("discharge_destination", pa.string()),
+        ("patient_classification", pa.string()), ("spell_core_hrg_sus", pa.string()),
+        ("primary_diagnosis", pa.string()), ("secondary_diagnosis", pa.string()), ("all_diagnoses", pa.string()),
+        ("all_procedures", pa.string()), ("days_in_critical_care", pa.int64()),
+    ),
+    "opa_diag": schema(
+        ("opa_ident", pa.int64()), ("primary_diagnosis_code", pa.string()), ("primary_diagnosis_code_read", pa.string()),
+        ("secondary_diagnosis_code_1", pa.string()), ("secondary_diagnosis_code_1_read", pa.string()),
+        ("appointment_date", pa.date32()), ("referral_request_received_date", pa.date32()),
+    ),
+    "emergency_care_attendances": schema(
+        ("id", pa.int64()), ("arrival_date", pa.date32()), ("discharge_destination", pa.string()),
+        *[(f"diagnosis_{i:02d}", pa.string()) for i in range(1, 25)],
+    ),
+    "ons_deaths": schema(
+        ("date", pa.date32()), ("underlying_cause_of_death", pa.string()),
+        *[(f"cause_of_death_{i:02d}", pa.string()) for i in range(1, 16)],
+    ),
+    "addresses": schema(
+        ("address_id", pa.int64()), ("start_date", pa.date32()), ("end_date", pa.date32()), ("address_type", pa.int64()),
+        ("rural_urban_classification", pa.int64()), ("imd_rounded", pa.int64()), ("msoa_code", pa.string()),
+        ("has_postcode", pa.bool_()), ("care_home_is_potential_match", pa.bool_()),
+        ("care_home_requires_nursing", pa.bool_()), ("care_home_does_not_require_nursing", pa.bool_()),
+    ),
+    "practice_registrations": schema(
+        ("start_date", pa.date32()), ("end_date", pa.date32()), ("practice_pseudo_id", pa.int64()),
+        ("practice_stp", pa.string()), ("practice_nuts1_region_name", pa.string()), ("practice_signup_date", pa.date32()),
+    ),
+}
+
+################################################################################
+# 1 Building blocks
+################################################################################
+def as_day(date):
+    return (datetime.date.fromisoformat(date) - datetime.date(1970, 1, 1)).days
+
+def dates(days):
+    return pa.array(np.asarray(days, dtype=np.int32)).cast(pa.date32())
+
+def codes(values, indices):
+    return pa.array(values, type=pa.string()).take(pa.array(indices, type=pa.int64()))
+
+# a table with the full schema: columns not given are null
+def full_table(table_name, columns):
+    schema = schemas[table_name]
+    n = len(columns["patient_id"])
+    return pa.table({
+        field.name: columns[field.name] if field.name in columns else pa.nulls(n, field.type) for field in schema
+    }).cast(schema)
+
+# n patients with any event (share), each with 1 + Poisson(mean - 1) events: returns the
+# row index into the batch for every event
+def draw_events(rng, n, share, mean, eligible=None):
+    has_any = rng.random(n) < share
+    if eligible is not None:
+        has_any &= eligible
+    counts = np.where(has_any, 1 + rng.poisson(max(mean - 1, 0), n), 0)
+    return np.repeat(np.arange(n), counts)
+
+################################################################################
+# 2 One batch of patients
+################################################################################
+def generate_batch(rng, first_patient_id, n, study, bari_prevalence):
+    patient_id = np.arange(first_patient_id, first_patient_id + n, dtype=np.int64)
+    start, end = study["start"], study["end"]
+    history_start = start - int(365.25 * history_years)
+    batch = {}
+
+    ## patients: month of birth (first of month), sex
+    birth_months = np.arange("1920-01", "2005-01", dtype="datetime64[M]").astype("datetime64[D]").astype(np.int32)
+    date_of_birth = rng.choice(birth_months, n)
+    sex = rng.choice(2, n)
+    female = sex == 0
+
+    ## covid_therapeutics: baricitinib treatments within the study window
+    exposed = rng.random(n) < bari_prevalence
+    treated = draw_events(rng, n, 1, 1.5, exposed)
+    first_treatment = np.full(n, end, dtype=np.int32)
+    treatment_day = rng.integers(start, end + 1, len(treated)).astype(np.int32)
+    np.minimum.at(first_treatment, treated, treatment_day)
+    batch["covid_therapeutics"] = full_table("covid_therapeutics", {
+        "patient_id": patient_id[treated],
+        "covid_indication": codes(bari_settings, rng.choice(2, len(treated), p=[0.8, 0.2])),
+        "current_status": codes(bari_statuses, rng.choice(4, len(treated), p=[0.6, 0.3, 0.05, 0.05])),
+        "intervention": codes(["Baricitinib"], np.zeros(len(treated), dtype=np.int64)),
+        "received": dates(treatment_day),
+        "treatment_start_date": dates(treatment_day),
+    })
+
+    ## deaths: more likely, and shortly after treatment, for exposed patients; the
+    ## underlying cause is also the first cause listed on the certificate
+    died = rng.random(n) < np.where(exposed, 0.15, 0.01)
+    death_day = np.where(exposed, first_treatment + rng.integers(0, 90, n), rng.integers(start, end + 1, n))
+    died &= death_day <= end
+    covid_death = rng.random(n) < 0.5
+    batch["patients"] = full_table("patients", {
+        "patient_id": patient_id,
+        "date_of_birth": dates(date_of_birth),
+        "sex": codes(["female", "male"], sex),
+        "date_of_death": pa.array(death_day.astype(np.int32), mask=~died).cast(pa.date32()),
+    })
+    death_rows = np.flatnonzero(died)
+    cause_of_death = codes(codelists.covid_codes + ["I219"], np.where(covid_death[death_rows], 0, 1))
+    batch["ons_deaths"] = full_table("ons_deaths", {
+        "patient_id": patient_id[death_rows],
+        "date": dates(death_day[death_rows]),
+        "underlying_cause_of_death": cause_of_death,
+        "cause_of_death_01": cause_of_death,
+    })
+
+    ## event tables: codelist events plus background events
+    for table_name, specs in event_codelists.items():
+        pieces = []
+        for codelist_name, code_column, share, mean, for_sex in specs:
+            eligible = None if for_sex is None else (female if for_sex == "female" else ~female)
+            rows = draw_events(rng, n, share, mean, eligible)
+            codelist = list(getattr(codelists, codelist_name))
+            pieces.append((rows, code_column, codelist, rng.integers(0, len(codelist), len(rows))))
+        rows = draw_events(rng, n, 1, background_events[table_name])
+        code_column = background_columns[table_name]
+        used = {code for spec in specs if spec[1] == code_column for code in getattr(codelists, spec[0])}
+        background_codes = [code for code in background_code_shapes[code_column] if code not in used]
+        pieces.append((rows, code_column, background_codes, rng.integers(0, len(background_codes), len(rows))))
+        batch[table_name] = event_table(rng, table_name, pieces, patient_id, history_start, end)
+
+    ## apcs: a COVID-19 admission around each treatment in hospital
+    admission_day = treatment_day - rng.integers(0, 4, len(treated))
+    covid_admissions = full_table("apcs", {
+        "patient_id": patient_id[treated],
+        "admission_date": dates(admission_day),
+        "discharge_date": dates(admission_day + rng.integers(1, 30, len(treated))),
+        "primary_diagnosis": codes(codelists.covid_codes, np.zeros(len(treated), dtype=np.int64)),
+        "all_diagnoses": codes(codelists.covid_codes, np.zeros(len(treated), dtype=np.int64)),
+    })
+    batch["apcs"] = pa.concat_tables([batch["apcs"], covid_admissions])
+
+    ## addresses and practice registrations: one current row per patient
+    batch["addresses"] = full_table("addresses", {
+        "patient_id": patient_id,
+        "address_id": patient_id,
+        "start_date": dates(rng.integers(history_start, start, n)),
+        "imd_rounded": rng.integers(0, 329, n) * 100,
+        "rural_urban_classification": rng.integers(1, 9, n),
+        "has_postcode": np.ones(n, dtype=bool),
+        "care_home_is_potential_match": rng.random(n) < 0.01,
+        "care_home_requires_nursing": rng.random(n) < 0.005,
+        "care_home_does_not_require_nursing": rng.random(n) < 0.005,
+    })
+    registration_start = dates(rng.integers(history_start, start, n))
+    batch["practice_registrations"] = full_table("practice_registrations", {
+        "patient_id": patient_id,
+        "start_date": registration_start,
+        "practice_pseudo_id": rng.integers(1, 6500, n),
+        "practice_stp": codes([f"E54000{i:03d}" for i in range(42)], rng.integers(0, 42, n)),
+        "practice_nuts1_region_name": codes(regions, rng.integers(0, len(regions), n)),
+        "practice_signup_date": registration_start,
+    })
+    return batch
+
+# pieces: (row index into the batch, code column, codes, code index); the code columns
+# not drawn are null, except the apcs all_diagnoses, which holds the primary diagnosis
+def event_table(rng, table_name, pieces, patient_id, first_day, last_day):
+    date_column = event_date_columns[table_name]
+    tables = []
+    for rows, code_column, values, indices in pieces:
+        day = rng.integers(first_day, last_day + 1, len(rows))
+        columns = {"patient_id": patient_id[rows], date_column: dates(day), code_column: codes(values, indices)}
+        if table_name == "apcs":
+            columns["discharge_date"] = dates(day + rng.integers(1, 15, len(rows)))
+            columns["all_diagnoses"] = columns["primary_diagnosis"]
+        tables.append(full_table(table_name, columns))
+    return pa.concat_tables(tables)
+
+################################################################################
+# 3 Run: stream batches of patients to one Arrow file per table
+################################################################################
+def write_tables(output_dir, population_size, batch_size=250000, bari_prevalence=0.05, seed=209109):
+    with open("output/study_dates.json") as f:
+        study_dates = json.load(f)
+    study = {"start": as_day(study_dates["studystart_date"]), "end": as_day(study_dates["studyend_date"])}
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    sinks = {name: pa.OSFile(str(output_dir / f"{name}.arrow"), "wb") for name in schemas}
+    writers = {name: pa.ipc.new_file(sinks[name], schema) for name, schema in schemas.items()}
+    try:
+        for first in range(0, population_size, batch_size):
+            n = min(batch_size, population_size - first)
+            batch = generate_batch(rng, first + 1, n, study, bari_prevalence)
+            for name, table in batch.items():
+                writers[name].write_table(table)
+    finally:
+        for name in schemas:
+            writers[name].close()
+            sinks[name].close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--population-size", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=250000)
+    parser.add_argument("--bari-prevalence", type=float, default=0.05)
+    parser.add_argument("--output-dir", default="output/dummy_tables")
+    parser.add_argument("--seed", type=int, default=209109)
+    parser.add_argument("--prevalence", action="append", default=[], metavar="CODELIST=SHARE",
+                        help="override the share of patients with events from a codelist")
+    args = parser.parse_args()
+    known = {spec[0] for specs in event_codelists.values() for spec in specs}
+    for override in args.prevalence:
+        name, share = override.split("=")
+        if name not in known:
+            raise ValueError(f"--prevalence: unknown codelist {name!r}, expected one of {', '.join(sorted(known))}")
+        for specs in event_codelists.values():
+            specs[:] = [(spec[0], spec[1], float(share)) + spec[3:] if spec[0] == name else spec for spec in specs]
+
+    write_tables(args.output_dir, args.population_size, args.batch_size, args.bari_prevalence, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+################################################################################
+## This script does the following:
+# 1. --record: after a full extraction (generate_dataset), save its watermark: the
+#    studyend_date it was extracted with and the sha256 of output/dataset.arrow
+#    (output/dataset_extracted_watermark.json)
+# 2. Otherwise, merge an increment: import the previous dataset and the increment
+#    extracted with `-- --since-watermark <watermark of the previous dataset>`
+#    (output/dataset_increment.arrow), i.e. only the patients with rows dated after
+#    the previous end date. The watermark must belong to the previous dataset (same
+#    sha256). If it already ends on the current studyend_date (studyend_date not
+#    extended, e.g. the dummy-data run of all actions) there is nothing newer: the
+#    previous dataset is written through unchanged and the increment is ignored
+# 3. Replace those patients' rows in the previous dataset (and add new patients),
+#    keeping everyone else's rows as they were
+# 4. Save the merged dataset, sorted by patient_id, with its own watermark JSON
+#    recording which end dates it covers
+#
+# The actions in project.yaml cover one refresh of output/dataset.arrow. For the next
+# one (manual step), either run generate_dataset again, or extend studyend_date and
+# run the increment and merge on the merged dataset and its watermark:
+#   ehrql generate-dataset analysis/dataset_definition.py --output output/dataset_increment.arrow \
+#       -- --since-watermark output/dataset_watermark.json
+#   python analysis/incremental_dataset.py --previous output/dataset_merged.arrow \
+#       --previous-watermark output/dataset_watermark.json \
+#       --output output/dataset_merged_2.arrow --watermark output/dataset_watermark_2.json
+#
+# Rows corrected retrospectively (dated on or before the previous end date) are not
+# picked up by an increment: run generate_dataset again for a full refresh.
+################################################################################
+import argparse
+import datetime
+import hashlib
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from arrow_helper_functions import (
+    read_arrow,
+    write_arrow,
+)
+
+################################################################################
+# 1 Watermark: which dataset file, extracted up to which end date
+################################################################################
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_watermark(path, dataset_path, study_dates, **fields):
+    watermark = {
+        "dataset": str(dataset_path),
+        "sha256": file_sha256(dataset_path),
+        "studystart_date": study_dates["studystart_date"],
+        "studyend_date": study_dates["studyend_date"],
+        **fields,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(path, "w") as f:
+        json.dump(watermark, f, indent=2)
+    return watermark
+
+# True if there is anything newer than the previous dataset to merge
+def check_watermark(watermark, previous_path, study_dates):
+    if watermark["sha256"] != file_sha256(previous_path):
+        raise ValueError(f"the watermark of {watermark['dataset']} does not match {previous_path}: record the watermark of the dataset being merged into")
+    return watermark["studyend_date"] < study_dates["studyend_date"]
+
+################################################################################
+# 2 Merge: previous rows of the patients not in the increment, plus the increment
+################################################################################
+def merge_increment(previous, increment):
+    increment = increment.select(previous.column_names).cast(previous.schema)
+    kept = previous.filter(pc.invert(pc.is_in(previous.column("patient_id"), value_set=increment.column("patient_id"))))
+    merged = pa.concat_tables([kept, increment])
+    return merged.take(pc.sort_indices(merged, sort_keys=[("patient_id", "ascending")])), kept.num_rows
+
+################################################################################
+# 3 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", action="store_true", help="only save the watermark of --previous (after a full extraction)")
+    parser.add_argument("--previous", default="output/dataset.arrow")
+    parser.add_argument("--previous-watermark", default="output/dataset_extracted_watermark.json", help="watermark of --previous (written with --record, or by an earlier merge)")
+    parser.add_argument("--increment", default="output/dataset_increment.arrow")
+    parser.add_argument("--output", default="output/dataset_merged.arrow")
+    parser.add_argument("--watermark", default="output/dataset_watermark.json")
+    args = parser.parse_args()
+
+    with open("output/study_dates.json") as f:
+        study_dates = json.load(f)
+
+    if args.record:
+        previous = read_arrow(args.previous)
+        write_watermark(args.previous_watermark, args.previous, study_dates, n_patients=previous.num_rows)
+        print(f"{args.previous}: extracted up to {study_dates['studyend_date']}, {previous.num_rows} patients")
+        return
+
+    with open(args.previous_watermark) as f:
+        previous_watermark = json.load(f)
+    newer = check_watermark(previous_watermark, args.previous, study_dates)
+
+    previous = read_arrow(args.previous)
+    if newer:
+        increment = read_arrow(args.increment)
+        merged, n_kept = merge_increment(previous, increment)
+    else:
+        print(f"{args.previous} already covers up to {study_dates['studyend_date']}: written through unchanged")
+        increment = previous.slice(0, 0)
+        merged, n_kept = previous, previous.num_rows
+    write_arrow(merged, args.output)
+
+    write_watermark(
+        args.watermark, args.output, study_dates,
+        previous_studyend_date=previous_watermark["studyend_date"],
+        n_patients=merged.num_rows,
+        n_kept=n_kept,
+        n_reevaluated=increment.num_rows,
+    )
+    print(f"kept {n_kept} patients, re-evaluated {increment.num_rows}, {merged.num_rows} in total")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#######################################################################################
+# The helper-shaped variables of dataset_definition.py, for analysis/local_engine.py
+#######################################################################################
+# Each entry mirrors one helper call in dataset_definition.py (see the variable format
+# in local_engine.py), so the local results can be diffed against output/dataset.arrow.
+# Keep the two files in step when a helper-based variable is added or changed.
+import json
+
+from codelists import (
+    pregnancy_snomed_clinical,
+    cocp_dmd,
+    hrt_dmd,
+    prostate_cancer_snomed_clinical,
+    carehome,
+    ethnicity_codes,
+    solid_cancer_snomed_codes
+)
+
+#######################################################################################
+# IMPORT the dates
+#######################################################################################
+with open("output/study_dates.json") as f:
+  study_dates = json.load(f)
+studyend_date = study_dates["studyend_date"]
+studystart_date = study_dates["studystart_date"]
+
+#######################################################################################
+# Variables
+#######################################################################################
+def bari_between(setting, start, end, aggregate="first", value="treatment_start_date"):
+    return {
+        "table": "covid_therapeutics",
+        "where": {"intervention": ["Baricitinib"], "covid_indication": [setting]},
+        "start": start,
+        "end": end,
+        "aggregate": aggregate,
+        "value": value,
+    }
+
+index_date = "exp_date_bari_hosp_first"
+
+variables = {
+    ## Exposure
+    "exp_date_bari_hosp_first": bari_between("hospitalised_with", studystart_date, studyend_date),
+    "exp_date_bari_hosp_onset_first": bari_between("hospital_onset", studystart_date, studyend_date),
+    "exp_date_bari_hosp_second": bari_between("hospitalised_with", ("exp_date_bari_hosp_first", 1), studyend_date),
+    "exp_date_bari_hosp_third": bari_between("hospitalised_with", ("exp_date_bari_hosp_second", 1), studyend_date),
+    "cov_status_bari_hosp_first": bari_between("hospitalised_with", studystart_date, studyend_date, value="current_status"),
+    ## Quality assurance (over entire study period)
+    "qa_bin_pregnancy": {"table": "clinical_events", "columns": ["snomedct_code"], "codelist": pregnancy_snomed_clinical, "aggregate": "exists"},
+    "qa_bin_cocp": {"table": "medications", "columns": ["dmd_code"], "codelist": cocp_dmd, "aggregate": "exists"},
+    "qa_bin_hrt": {"table": "medications", "columns": ["dmd_code"], "codelist": hrt_dmd, "aggregate": "exists"},
+    "tmp_prostate_cancer_snomed": {"table": "clinical_events", "columns": ["snomedct_code"], "codelist": prostate_cancer_snomed_clinical, "aggregate": "exists"},
+    ## Covariates
+    "ethnicity_cat": {"table": "clinical_events", "columns": ["ctv3_code"], "codelist": ethnicity_codes, "aggregate": "last", "value": "ctv3_code"},
+    "tmp_care_home_code": {"table": "clinical_events", "columns": ["snomedct_code"], "codelist": carehome, "end": index_date, "aggregate": "exists"},
+    "cov_solid_cancer_new": {"table": "clinical_events", "columns": ["snomedct_code"], "codelist": solid_cancer_snomed_codes, "start": (index_date, -180), "end": index_date, "aggregate": "exists"},
+    "cov_solid_cancer_ever": {"table": "clinical_events", "columns": ["snomedct_code"], "codelist": solid_cancer_snomed_codes, "end": index_date, "aggregate": "exists"},
+}
+
+## Population: patients with a baricitinib treatment (either setting) in the study period
+population = ["exp_date_bari_hosp_first", "exp_date_bari_hosp_onset_first"]
@@ -0,0 +1,462 @@
+#######################################################################################
+# LOCAL columnar engine for the helper-function query shapes
+#######################################################################################
+# Evaluates the first/last/count/exists-between helpers of variable_helper_functions.py
+# on TPP-shaped tables stored as Arrow/Parquet files (one file per table, named after
+# the table, e.g. the tables written by analysis/dummy_data.py), without going through
+# ehrQL.
+#
+# Each event table is held in a per-patient CSR layout: rows sorted by patient and
+# date, and offsets[i]:offsets[i + 1] are the rows of patient_ids[i]. Dates are int32
+# days since 1970-01-01 and code columns are dictionary encoded, so codelist membership
+# is one lookup per distinct code and every helper is a handful of vectorized NumPy
+# kernels over the rows. By default, all variables on a table share one tagging pass
+# over its rows (see FUSED evaluation); --unfused evaluates them one by one.
+# With --code-index DIR, the variables a code-occurrence index can answer are read
+# from it instead of the tables (see analysis/code_index.py).
+#
+# Loading is most of a run: at 1M dummy patients, sorting and converting the tables takes
+# about 6-7s against 0.6s for evaluating the variables. With --csr-cache DIR the sorted
+# tables and their CSR arrays are saved on the first run (per table, with the size and
+# mtime of its source file) and memory-mapped by later runs on the same tables, which
+# skip the sort and the conversions: at 1M patients a repeat run loads in 0.03s and
+# evaluates in about 1.1s (the rows are paged in on first use).
+#
+# Usage (from the repo root):
+#   python analysis/local_engine.py --tables <dir> --output output/local_dataset.arrow \
+#       --compare output/dataset.arrow
+import argparse
+import datetime
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from arrow_helper_functions import (
+    days_as_date_array,
+    missing_day,
+    read_arrow,
+    write_arrow,
+)
+
+# date column of each event table, used to sort the rows within each patient
+event_date_columns = {
+    "clinical_events": "date",
+    "medications": "date",
+    "apcs": "admission_date",
+    "opa_diag": "appointment_date",
+    "emergency_care_attendances": "arrival_date",
+    "covid_therapeutics": "treatment_start_date",
+}
+
+#######################################################################################
+### LOAD tables
+#######################################################################################
+def source_file(tables_dir, table_name):
+    for suffix in [".arrow", ".feather", ".parquet"]:
+        path = Path(tables_dir) / f"{table_name}{suffix}"
+        if path.exists():
+            return path
+    raise FileNotFoundError(f"no .arrow/.feather/.parquet file for table {table_name!r} in {tables_dir}")
+
+def source_stamp(path):
+    stat = Path(path).stat()
+    return {"source": str(path), "source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+def read_table(tables_dir, table_name):
+    path = source_file(tables_dir, table_name)
+    return pq.read_table(path) if path.suffix == ".parquet" else read_arrow(path)
+
+def as_days(column):
+    return column.cast(pa.date32()).cast(pa.int32()).fill_null(missing_day).to_numpy()
+
+csr_arrays = ["patient_ids", "offsets", "row_patient", "dates"]
+
+class EventTable:
+    # csr: the arrays of csr_arrays of an already sorted table (from the CSR cache)
+    def __init__(self, table, date_column, csr=None):
+        if csr is not None:
+            for name in csr_arrays:
+                setattr(self, name, csr[name])
+        else:
+            table = table.sort_by([("patient_id", "ascending"), (date_column, "ascending")])
+            row_patient_ids = table.column("patient_id").to_numpy()
+            boundaries = np.flatnonzero(np.diff(row_patient_ids)) + 1
+            self.patient_ids = row_patient_ids[np.r_[0, boundaries]] if len(row_patient_ids) else row_patient_ids
+            self.offsets = np.r_[0, boundaries, len(row_patient_ids)].astype(np.int64)
+            self.row_patient = np.repeat(np.arange(len(self.patient_ids)), np.diff(self.offsets))
+            self.dates = as_days(table.column(date_column))
+        self.date_column = date_column
+        self.table = table
+        self.encoded = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    # dictionary encoded column: (int32 indices per row, numpy array of distinct values)
+    def encode(self, column_name):
+        if column_name not in self.encoded:
+            encoded = pc.dictionary_encode(self.table.column(column_name)).combine_chunks()
+            indices = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int32)
+            self.encoded[column_name] = (indices, encoded.dictionary.to_numpy(zero_copy_only=False))
+        return self.encoded[column_name]
+
+    # cohort first: a new EventTable with only the rows of these patients
+    def for_patients(self, patient_ids):
+        positions, found = patient_positions(self, patient_ids)
+        starts = self.offsets[positions[found]]
+        lengths = self.offsets[positions[found] + 1] - starts
+        rows = np.repeat(starts - np.cumsum(np.r_[0, lengths[:-1]]), lengths) + np.arange(lengths.sum())
+        return EventTable(self.table.take(rows), self.date_column)
+
+# CSR cache: <cache_dir>/<table>/ holds the sorted table (table.arrow), one .npy file
+# per CSR array and manifest.json (the source stamp, written last), all memory-mapped
+# when loaded; a cache whose stamp differs from the source file is rebuilt
+def load_event_table(tables_dir, table_name, cache_dir=None):
+    date_column = event_date_columns[table_name]
+    if cache_dir is None:
+        return EventTable(read_table(tables_dir, table_name), date_column)
+    entry_dir = Path(cache_dir) / table_name
+    stamp = source_stamp(source_file(tables_dir, table_name))
+    try:
+        with open(entry_dir / "manifest.json") as f:
+            cached = json.load(f) == stamp
+    except (OSError, ValueError):
+        cached = False
+    if cached:
+        csr = {name: np.load(entry_dir / f"{name}.npy", mmap_mode="r") for name in csr_arrays}
+        return EventTable(read_arrow(entry_dir / "table.arrow"), date_column, csr)
+    events = EventTable(read_table(tables_dir, table_name), date_column)
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    write_arrow(events.table, entry_dir / "table.arrow")
+    for name in csr_arrays:
+        np.save(entry_dir / f"{name}.npy", getattr(events, name))
+    with open(entry_dir / "manifest.json", "w") as f:
+        json.dump(stamp, f)
+    return events
+
+#######################################################################################
+### ROW selection: masks over all rows, or sorted arrays of row indices
+#######################################################################################
+# per distinct value of a column (plus a last entry for null): the codelist lookup
+def dictionary_lookup(dictionary, lookup, missing, dtype=bool):
+    return np.array([lookup(value) for value in dictionary] + [missing], dtype=dtype)
+
+# rows where any of the columns is in the codelist
+def codelist_mask(events, column_names, codelist):
+    codes = set(codelist)
+    mask = np.zeros(len(events), dtype=bool)
+    for column_name in column_names:
+        indices, dictionary = events.encode(column_name)
+        mask |= dictionary_lookup(dictionary, codes.__contains__, False)[indices]
+    return mask
+
+# the rows (indices) on or between start and end; start/end are None, a day number, or
+# day numbers per patient of events.patient_ids (missing_day: no rows for that patient)
+def window_rows(events, rows, start=None, end=None):
+    if start is None and end is None:
+        return rows
+    dates = events.dates[rows]
+    keep = dates != missing_day
+    for limit, on_or_after in [(start, True), (end, False)]:
+        if limit is None:
+            continue
+        limit = np.asarray(limit)
+        row_limit = limit[events.row_patient[rows]] if limit.ndim else limit
+        keep &= ((dates >= row_limit) if on_or_after else (dates <= row_limit)) & (row_limit != missing_day)
+    return rows[keep]
+
+#######################################################################################
+### AGGREGATE kernels over sorted row indices: one value per patient of events.patient_ids
+#######################################################################################
+def count_for_patient(events, rows):
+    return np.bincount(events.row_patient[rows], minlength=len(events.patient_ids))
+
+def exists_for_patient(events, rows):
+    return count_for_patient(events, rows) > 0
+
+# row index of the first/last row (rows are date sorted within patient), -1 if none
+def first_row_for_patient(events, rows, last=False):
+    patients = events.row_patient[rows]
+    if not len(rows):
+        keep = np.zeros(0, dtype=bool)
+    elif last:
+        keep = np.r_[patients[1:] != patients[:-1], True]
+    else:
+        keep = np.r_[True, patients[1:] != patients[:-1]]
+    picked = np.full(len(events.patient_ids), -1, dtype=np.int64)
+    picked[patients[keep]] = rows[keep]
+    return picked
+
+def last_row_for_patient(events, rows):
+    return first_row_for_patient(events, rows, last=True)
+
+# value of a column at the picked rows: dates as days, other columns as objects (None if
+# no row), optionally mapped through categories (code -> category)
+def column_at(events, column_name, picked, categories=None):
+    if column_name == events.date_column:
+        return np.where(picked >= 0, events.dates[picked], missing_day).astype(np.int32)
+    indices, dictionary = events.encode(column_name)
+    if categories is not None:
+        dictionary = dictionary_lookup(dictionary, categories.get, None, dtype=object)[:-1]
+    return np.append(dictionary, None)[np.where(picked >= 0, indices[picked], -1)]
+
+#######################################################################################
+### ALIGN per-table results to the population
+#######################################################################################
+# positions of patient_ids in events.patient_ids, and whether they are present
+def patient_positions(events, patient_ids):
+    positions = np.searchsorted(events.patient_ids, patient_ids)
+    positions = np.minimum(positions, max(len(events.patient_ids) - 1, 0))
+    found = (events.patient_ids[positions] == patient_ids) if len(events.patient_ids) else np.zeros(len(patient_ids), dtype=bool)
+    return positions, found
+
+def to_events(events, patient_ids, values):
+    values = np.asarray(values)
+    if not values.ndim:
+        return values
+    per_event_patient = np.full(len(events.patient_ids), missing_day, dtype=np.int32)
+    positions, found = patient_positions(events, patient_ids)
+    per_event_patient[positions[found]] = values[found]
+    return per_event_patient
+
+def to_population(events, patient_ids, values, missing):
+    positions, found = patient_positions(events, patient_ids)
+    result = np.full(len(patient_ids), missing, dtype=values.dtype)
+    result[found] = values[positions[found]]
+    return result
+
+#######################################################################################
+### EVALUATE variables
+#######################################################################################
+# A variable is a dict mirroring a helper call:
+#   table:     event table name
+#   columns:   code columns, any of which is in codelist (omit for no codelist filter)
+#   codelist:  codes (list) or code -> category (dict, gives the category for "first"/"last")
+#   where:     {column: allowed values}, all of which must hold
+#   start/end: None, "YYYY-MM-DD", an earlier variable name, or (variable name, offset days)
+#   aggregate: "exists", "count", "first" or "last"
+#   value:     column returned by "first"/"last" (default: the date column)
+def parse_day(value, results):
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        name, offset = value
+        days = results[name]
+        return np.where(days == missing_day, missing_day, days + offset).astype(np.int32)
+    if value in results:
+        return results[value]
+    return np.int32((datetime.date.fromisoformat(value) - datetime.date(1970, 1, 1)).days)
+
+def matching_mask(events, variable):
+    mask = np.ones(len(events), dtype=bool)
+    if variable.get("columns"):
+        mask &= codelist_mask(events, variable["columns"], variable["codelist"])
+    for column_name, allowed in variable.get("where", {}).items():
+        mask &= codelist_mask(events, [column_name], allowed)
+    return mask
+
+# matching rows (default: all rows matching the codelist and where), within the window
+def variable_rows(events, variable, patient_ids, results, rows=None):
+    if rows is None:
+        rows = np.flatnonzero(matching_mask(events, variable))
+    limits = [
+        to_events(events, patient_ids, parse_day(variable.get(limit), results)) if variable.get(limit) is not None else None
+        for limit in ["start", "end"]
+    ]
+    return window_rows(events, rows, *limits)
+
+def aggregate_variable(events, variable, rows, patient_ids):
+    aggregate = variable["aggregate"]
+    if aggregate == "exists":
+        return to_population(events, patient_ids, exists_for_patient(events, rows), False)
+    if aggregate == "count":
+        return to_population(events, patient_ids, count_for_patient(events, rows), 0)
+    if aggregate == "last":
+        picked = last_row_for_patient(events, rows)
+    else:
+        picked = first_row_for_patient(events, rows)
+    value = variable.get("value", events.date_column)
+    categories = variable.get("codelist") if value in variable.get("columns", []) else None
+    values = column_at(events, value, picked, categories if isinstance(categories, dict) else None)
+    missing = missing_day if value == events.date_column else None
+    return to_population(events, patient_ids, values, missing)
+
+def evaluate_variable(events, variable, patient_ids, results, rows=None):
+    return aggregate_variable(events, variable, variable_rows(events, variable, patient_ids, results, rows), patient_ids)
+
+def evaluate_variables(tables, variables, patient_ids):
+    results = {}
+    for name, variable in variables.items():
+        results[name] = evaluate_variable(tables[variable["table"]], variable, patient_ids, results)
+    return results
+
+#######################################################################################
+### FUSED evaluation: one pass over each table for all of its variables
+#######################################################################################
+# Variables on the same table are planned into groups of up to 64. Every row gets a
+# uint64 bitmask with bit i set when it matches variable i of its group (codelist OR'd
+# over the code columns, where-conditions AND'd), computed once per distinct value of
+# each column that any variable in the group reads. Each variable's candidate rows are
+# then the rows with its bit set, and only the window and aggregate are per variable.
+max_fused = 64
+
+def plan_by_table(variables):
+    plan = {}
+    for name, variable in variables.items():
+        groups = plan.setdefault(variable["table"], [[]])
+        if len(groups[-1]) == max_fused:
+            groups.append([])
+        groups[-1].append(name)
+    return plan
+
+# candidate rows per variable of one group, from a single tagging pass over the table
+def tag_rows(events, variables):
+    bits = {name: np.uint64(1) << np.uint64(i) for i, name in enumerate(variables)}
+    all_bits = np.uint64(sum(int(bit) for bit in bits.values()))
+    code_sets = {name: set(variable["codelist"]) for name, variable in variables.items() if variable.get("columns")}
+    where_sets = {
+        name: {column_name: set(allowed) for column_name, allowed in variable.get("where", {}).items()}
+        for name, variable in variables.items()
+    }
+
+    # codelist: a variable's bit is set on rows where any of its columns matches;
+    # variables without a codelist match every row
+    matched = np.full(len(events), np.uint64(sum(int(bits[name]) for name in variables if name not in code_sets)))
+    code_columns = {column_name for name in code_sets for column_name in variables[name]["columns"]}
+    for column_name in sorted(code_columns):
+        indices, dictionary = events.encode(column_name)
+        lookup = np.zeros(len(dictionary) + 1, dtype=np.uint64)
+        for name, codes in code_sets.items():
+            if column_name in variables[name]["columns"]:
+                lookup[:-1] |= np.where([value in codes for value in dictionary], bits[name], np.uint64(0)).astype(np.uint64)
+        matched |= lookup[indices]
+
+    # where: a variable's bit is cleared on rows failing any of its conditions
+    where_columns = {column_name for conditions in where_sets.values() for column_name in conditions}
+    for column_name in sorted(where_columns):
+        indices, dictionary = events.encode(column_name)
+        lookup = np.full(len(dictionary) + 1, all_bits, dtype=np.uint64)
+        for name, conditions in where_sets.items():
+            if column_name in conditions:
+                fails = np.array([value not in conditions[column_name] for value in dictionary] + [True])
+                lookup[fails] &= ~bits[name]
+        matched &= lookup[indices]
+
+    return {name: np.flatnonzero(matched & bit) for name, bit in bits.items()}
+
+# same results as evaluate_variables; evaluated in definition order, so variables can
+# still refer to earlier ones in start/end.
+# Not evaluated concurrently: after fusion each table is one tagging pass, and what is
+# left per variable is a window and an aggregate over its candidate rows. Threads did
+# not help (the per-code loops and small array calls hold the GIL: 0.60s against 0.39s
+# serially on 50k patients), and a process pool would have to share the CSR tables
+# with every worker, which costs more than the evaluation it would split.
+def evaluate_fused(tables, variables, patient_ids):
+    candidates = {}
+    for table_name, groups in plan_by_table(variables).items():
+        for group in groups:
+            candidates.update(tag_rows(tables[table_name], {name: variables[name] for name in group}))
+    results = {}
+    for name, variable in variables.items():
+        results[name] = evaluate_variable(tables[variable["table"]], variable, patient_ids, results, candidates.pop(name))
+    return results
+
+# cohort first: patients with a value for any of the population variables
+def population_ids(tables, variables, population, patient_ids):
+    results = evaluate_variables(tables, {name: variables[name] for name in population}, patient_ids)
+    in_population = np.zeros(len(patient_ids), dtype=bool)
+    for values in results.values():
+        in_population |= values != missing_day
+    return patient_ids[in_population]
+
+def results_table(patient_ids, results):
+    columns = {"patient_id": pa.array(patient_ids)}
+    for name, values in results.items():
+        if values.dtype == np.int32:
+            columns[name] = days_as_date_array(values)
+        else:
+            columns[name] = pa.array(values)
+    return pa.table(columns)
+
+#######################################################################################
+### COMPARE with the official ehrQL output
+#######################################################################################
+# number of patients (present in both) whose value differs, per shared column
+def compare_with_dataset(local, official):
+    official_ids = official.column("patient_id").to_numpy()
+    local_ids = local.column("patient_id").to_numpy()
+    shared_ids = np.intersect1d(local_ids, official_ids)
+    local_rows = np.searchsorted(local_ids, shared_ids)
+    official_rows = pc.index_in(pa.array(shared_ids), official.column("patient_id")).to_numpy()
+    mismatches = {
+        "n_local_only": int(len(local_ids) - len(shared_ids)),
+        "n_official_only": int(len(official_ids) - len(shared_ids)),
+    }
+    for name in local.column_names[1:]:
+        if name in official.column_names:
+            local_values = local.column(name).take(local_rows)
+            official_values = official.column(name).take(official_rows).cast(local_values.type)
+            same = pc.fill_null(pc.equal(local_values, official_values), False)
+            both_null = pc.and_(pc.is_null(local_values), pc.is_null(official_values))
+            mismatches[name] = int(len(shared_ids) - pc.sum(pc.or_(same, both_null)).as_py())
+    return mismatches
+
+#######################################################################################
+### RUN
+#######################################################################################
+def load_tables(tables_dir, variables, cache_dir=None):
+    return {
+        table_name: load_event_table(tables_dir, table_name, cache_dir)
+        for table_name in sorted({variable["table"] for variable in variables.values()})
+    }
+
+def main():
+    from local_dataset_definition import population, variables
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", required=True, help="directory with one Arrow/Parquet file per table")
+    parser.add_argument("--output", default="output/local_dataset.arrow")
+    parser.add_argument("--compare", help="official ehrQL output to diff against")
+    parser.add_argument("--unfused", action="store_true", help="evaluate each variable with its own pass over its table")
+    parser.add_argument("--csr-cache", help="directory to save the sorted tables in, memory-mapped by later runs on the same tables")
+    parser.add_argument("--code-index", help="code-occurrence index (analysis/code_index.py) to answer the variables it can")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.code_index:
+        from code_index import evaluate_with_index, index_entry_name, load_index
+        index = load_index(args.code_index, args.tables)
+        # only the tables of the variables the index cannot answer (and of the population)
+        table_variables = {
+            name: variable for name, variable in variables.items()
+            if name in population or index_entry_name(variable) not in index
+        }
+    else:
+        table_variables = variables
+    tables = load_tables(args.tables, table_variables, args.csr_cache)
+    patient_ids = np.sort(read_table(args.tables, "patients").column("patient_id").to_numpy())
+    loaded = time.perf_counter()
+    patient_ids = population_ids(tables, variables, population, patient_ids)
+    tables = {name: events.for_patients(patient_ids) for name, events in tables.items()}
+    if args.code_index:
+        results = evaluate_with_index(index, tables, variables, patient_ids)
+    elif args.unfused:
+        results = evaluate_variables(tables, variables, patient_ids)
+    else:
+        results = evaluate_fused(tables, variables, patient_ids)
+    local = results_table(patient_ids, results)
+    evaluated = time.perf_counter()
+    write_arrow(local, args.output)
+    print(f"loaded tables in {loaded - start:.2f}s, evaluated {len(variables)} variables for {len(patient_ids)} patients in {evaluated - loaded:.2f}s")
+
+    if args.compare:
+        for name, n in compare_with_dataset(local, read_arrow(args.compare)).items():
+            print(f"{name}: {n}")
+
+if __name__ == "__main__":
+    main()
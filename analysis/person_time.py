@@ -0,0 +1,162 @@
+################################################################################
+## This script does the following:
+# 1. Import the exposure, outcome and death dates from dataset.arrow, and the
+#    baricitinib treatment episodes from bari_episodes.arrow (analysis/bari_episodes.py)
+# 2. Follow-up per patient: from the index date (--index-column: exp_date_bari_index in
+#    the cohort datasets of analysis/split_cohorts.py, else exp_date_bari_hosp_first) up
+#    to the earliest of the outcome, death, studyend_date and the start of the next
+#    treatment episode (either setting; follow-up stops the day before it). Treatment
+#    dates within --gap-days of each other are one episode, so the later rows of the
+#    course the index date belongs to do not end follow-up. The outcome must be
+#    measured from the same index date (a cohort dataset's out_date_* columns are)
+# 3. Lexis-split each patient's follow-up at the time-since-exposure bands and the
+#    calendar period cut dates, all patients at once on a padded cut-date matrix
+# 4. Save one row per patient-interval: start and end date (inclusive), person-days,
+#    time-since-exposure band, calendar period and whether the outcome occurred
+################################################################################
+import argparse
+import datetime
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from arrow_helper_functions import (
+    date_column_as_days,
+    days_as_date_array,
+    missing_day,
+    read_arrow,
+    write_arrow,
+)
+
+################################################################################
+# 0 Settings
+################################################################################
+# index date column of a cohort dataset (analysis/split_cohorts.py) and of dataset.arrow
+cohort_index_column = "exp_date_bari_index"
+default_index_column = "exp_date_bari_hosp_first"
+death_column = "qa_date_of_death"
+# time since exposure: band i starts this many days after the index date
+default_bands = [0, 7, 14, 28, 56, 90, 180, 365]
+# days are int64 here, so "no date" (missing_day) can be compared with any date
+no_day = np.int64(missing_day)
+
+def as_day(date):
+    return (datetime.date.fromisoformat(date) - datetime.date(1970, 1, 1)).days
+
+def band_labels(bands):
+    return [f"{start}-{end - 1}" for start, end in zip(bands[:-1], bands[1:])] + [f"{bands[-1]}+"]
+
+################################################################################
+# 1 Follow-up: [start, end) in days, and whether it ends with the outcome
+################################################################################
+# the rows of episodes (one per patient_id, bari_episodes.arrow) in the order of
+# patient_ids; patients without a row get no episodes
+def align_episodes(episodes, patient_ids):
+    return episodes.take(pc.index_in(patient_ids, value_set=episodes.column("patient_id")))
+
+# start of the first episode starting after the index date: the index date lies in an
+# earlier episode, so this is the next course of treatment
+def next_exposure(episodes, start):
+    next_day = np.full(len(start), no_day)
+    episode_start = episodes.column("episode_start_date").combine_chunks()
+    patient = pc.list_parent_indices(episode_start).to_numpy()
+    days = pc.list_flatten(episode_start).cast(pa.int32()).to_numpy(zero_copy_only=False).astype(np.int64)
+    later = days > start[patient]
+    np.minimum.at(next_day, patient[later], days[later])
+    return next_day
+
+def follow_up(table, episodes, index_column, outcome_column, studyend_day):
+    start = date_column_as_days(table, index_column).astype(np.int64)
+    outcome = date_column_as_days(table, outcome_column).astype(np.int64)
+    death = date_column_as_days(table, death_column).astype(np.int64)
+    ends = np.column_stack([
+        np.where(outcome != no_day, outcome + 1, no_day),
+        np.where(death != no_day, death + 1, no_day),
+        np.full(len(start), studyend_day + 1),
+        next_exposure(episodes, start),
+    ])
+    end = ends.min(axis=1)
+    event = (outcome != no_day) & (outcome + 1 == end)
+    keep = (start != no_day) & (end > start)
+    return keep, start, end, event
+
+################################################################################
+# 2 Lexis split: every interval between consecutive cut dates within [start, end)
+################################################################################
+def lexis_split(start, end, event, bands, calendar_cuts):
+    n = len(start)
+    cuts = np.concatenate([
+        start[:, None] + np.asarray(bands[1:], dtype=np.int64)[None, :],
+        np.broadcast_to(np.asarray(calendar_cuts, dtype=np.int64), (n, len(calendar_cuts))),
+    ], axis=1)
+    cuts = np.where((cuts > start[:, None]) & (cuts < end[:, None]), cuts, no_day)
+    cuts.sort(axis=1)
+    # a band cut on a calendar cut date: keep it once
+    cuts[:, 1:][cuts[:, 1:] == cuts[:, :-1]] = no_day
+    cuts.sort(axis=1)
+    n_cuts = (cuts != no_day).sum(axis=1)
+
+    # interval k of a patient runs from cut k-1 (or start) to cut k (or end)
+    k = np.arange(cuts.shape[1] + 1)[None, :]
+    interval_start = np.concatenate([start[:, None], cuts], axis=1)
+    interval_end = np.concatenate([cuts, np.full((n, 1), no_day)], axis=1)
+    interval_end = np.where(k == n_cuts[:, None], end[:, None], interval_end)
+    valid = k <= n_cuts[:, None]
+
+    patient = np.nonzero(valid)[0]
+    interval_start = interval_start[valid]
+    interval_end = interval_end[valid]
+    last = (k == n_cuts[:, None])[valid]
+    band = np.searchsorted(bands, interval_start - start[patient], side="right") - 1
+    period = np.searchsorted(calendar_cuts, interval_start, side="right")
+    return patient, interval_start, interval_end, band, period, last & event[patient]
+
+################################################################################
+# 3 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/dataset.arrow")
+    parser.add_argument("--episodes", default="output/bari_episodes.arrow", help="treatment episodes of both settings (next exposure), from analysis/bari_episodes.py")
+    parser.add_argument("--outcome", default="out_date_covid_hosp")
+    parser.add_argument("--index-column", help=f"index date column (default: {cohort_index_column} if the input has it, else {default_index_column})")
+    parser.add_argument("--bands", type=int, nargs="+", default=default_bands, help="start (days since exposure) of each band")
+    parser.add_argument("--calendar-cuts", nargs="*", help="calendar period start dates (default: every 1 January in the study period)")
+    parser.add_argument("--output", help="default: output/person_time_<outcome>.arrow")
+    args = parser.parse_args()
+
+    with open("output/study_dates.json") as f:
+        study_dates = json.load(f)
+    studystart_year = datetime.date.fromisoformat(study_dates["studystart_date"]).year
+    studyend_year = datetime.date.fromisoformat(study_dates["studyend_date"]).year
+    calendar_dates = args.calendar_cuts if args.calendar_cuts is not None else [
+        f"{year}-01-01" for year in range(studystart_year + 1, studyend_year + 1)
+    ]
+    calendar_cuts = np.array([as_day(date) for date in calendar_dates], dtype=np.int64)
+    period_labels = [f"before {calendar_dates[0]}" if calendar_dates else "all"] + [f"from {date}" for date in calendar_dates]
+
+    table = read_arrow(args.input)
+    index_column = args.index_column or (cohort_index_column if cohort_index_column in table.column_names else default_index_column)
+    episodes = align_episodes(read_arrow(args.episodes), table.column("patient_id"))
+    keep, start, end, event = follow_up(table, episodes, index_column, args.outcome, as_day(study_dates["studyend_date"]))
+    patient_ids = table.column("patient_id").to_numpy()[keep]
+    patient, interval_start, interval_end, band, period, interval_event = lexis_split(
+        start[keep], end[keep], event[keep], np.asarray(args.bands), calendar_cuts
+    )
+
+    person_time = pa.table({
+        "patient_id": pa.array(patient_ids[patient]),
+        "interval_start_date": days_as_date_array(interval_start),
+        "interval_end_date": days_as_date_array(interval_end - 1),
+        "person_days": pa.array(interval_end - interval_start, type=pa.int32()),
+        "time_since_exposure_cat": pa.DictionaryArray.from_arrays(pa.array(band, type=pa.int8()), band_labels(args.bands)),
+        "calendar_period_cat": pa.DictionaryArray.from_arrays(pa.array(period, type=pa.int8()), period_labels),
+        "event_bin": pa.array(interval_event),
+    })
+    write_arrow(person_time, args.output or f"output/person_time_{args.outcome}.arrow")
+    print(f"{int(keep.sum())} patients, {person_time.num_rows} intervals, {int(event[keep].sum())} events, {int((end - start)[keep].sum())} person-days")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+################################################################################
+## This script does the following:
+# 1. Stream dataset.arrow (or several shards) record batch by record batch, typing each
+#    batch by the variable naming convention (analysis/type_dataset.py)
+# 2. Per column keep a small mergeable summary: number of rows and of missing values,
+#    min/max/mean and approximate quantiles (_date, _num), category frequencies (_cat
+#    and other text columns) and true/false counts (_bin); summaries of different
+#    batches or shards are combined with merge_summaries()
+# 3. Save the data properties: output/data_properties/profile/profile_variables.csv and
+#    profile_categories.csv (highly sensitive: exact counts and statistics), and the
+#    same with counts rounded to midpoint6 (as fn_roundmid_any.R, threshold 6), the only
+#    ones released (moderately sensitive). In those, _date and _num columns have no
+#    min/max or p5/p95 (single patients' values), and the mean and quartiles are
+#    coarsened (dates to the month, numbers to 1 decimal) and left empty when fewer than
+#    min_released_n values (after rounding) are behind them
+#
+# Memory stays constant in the number of patients: only one batch and the summaries
+# (the quantile sketch keeps O(sketch_size * log(n)) values per column) are held.
+################################################################################
+import argparse
+import csv
+import datetime
+import math
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from type_dataset import type_columns
+
+threshold = 6
+min_released_n = 7
+released_quantiles = [0.25, 0.5, 0.75]
+quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+# items per level of the quantile sketch
+sketch_size = 256
+rng = np.random.default_rng(209109)
+
+################################################################################
+# 0 Quantile sketch: levels of sorted samples, level l stands for 2**l values each
+#   (full levels are halved, keeping every other value, and promoted: as in KLL)
+################################################################################
+def compact(levels):
+    level = 0
+    while level < len(levels):
+        if len(levels[level]) > sketch_size:
+            items = np.sort(levels[level])
+            leftover, items = items[len(items) - len(items) % 2:], items[:len(items) - len(items) % 2]
+            levels[level] = leftover
+            if level + 1 == len(levels):
+                levels.append(np.empty(0))
+            levels[level + 1] = np.concatenate([levels[level + 1], items[rng.integers(2)::2]])
+        level += 1
+    return levels
+
+def sketch_quantiles(levels):
+    values = np.concatenate(levels)
+    if not len(values):
+        return [None] * len(quantiles)
+    weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(levels)])
+    order = np.argsort(values, kind="stable")
+    cumulative = np.cumsum(weights[order])
+    positions = np.searchsorted(cumulative, np.array(quantiles) * cumulative[-1], side="left")
+    return [float(values[order][min(position, len(values) - 1)]) for position in positions]
+
+################################################################################
+# 1 Summaries per column kind: new, update with one batch column, merge two
+################################################################################
+def column_kind(data_type):
+    if pa.types.is_date(data_type):
+        return "date"
+    if pa.types.is_integer(data_type) or pa.types.is_floating(data_type):
+        return "num"
+    if pa.types.is_boolean(data_type):
+        return "bin"
+    return "cat"
+
+def new_summary(kind):
+    summary = {"kind": kind, "n": 0, "n_missing": 0}
+    if kind in ("date", "num"):
+        summary.update({"min": math.inf, "max": -math.inf, "sum": 0.0, "levels": [np.empty(0)]})
+    elif kind == "bin":
+        summary.update({"n_true": 0})
+    else:
+        summary.update({"categories": {}})
+    return summary
+
+def update_summary(summary, column):
+    summary["n"] += len(column)
+    summary["n_missing"] += column.null_count
+    kind = summary["kind"]
+    if kind in ("date", "num"):
+        if kind == "date":
+            column = column.cast(pa.int32())
+        values = column.drop_null().to_numpy(zero_copy_only=False).astype(np.float64)
+        if len(values):
+            summary["min"] = min(summary["min"], values.min())
+            summary["max"] = max(summary["max"], values.max())
+            summary["sum"] += values.sum()
+            summary["levels"][0] = np.concatenate([summary["levels"][0], values])
+            compact(summary["levels"])
+    elif kind == "bin":
+        summary["n_true"] += pc.sum(column).as_py() or 0
+    else:
+        counts = pc.value_counts(column.drop_null())
+        for value, count in zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist()):
+            summary["categories"][value] = summary["categories"].get(value, 0) + count
+    return summary
+
+def merge_summaries(a, b):
+    merged = {"kind": a["kind"], "n": a["n"] + b["n"], "n_missing": a["n_missing"] + b["n_missing"]}
+    if a["kind"] in ("date", "num"):
+        levels = [
+            np.concatenate([a["levels"][level] if level < len(a["levels"]) else np.empty(0),
+                            b["levels"][level] if level < len(b["levels"]) else np.empty(0)])
+            for level in range(max(len(a["levels"]), len(b["levels"])))
+        ]
+        merged.update({"min": min(a["min"], b["min"]), "max": max(a["max"], b["max"]), "sum": a["sum"] + b["sum"], "levels": compact(levels)})
+    elif a["kind"] == "bin":
+        merged["n_true"] = a["n_true"] + b["n_true"]
+    else:
+        merged["categories"] = dict(a["categories"])
+        for value, count in b["categories"].items():
+            merged["categories"][value] = merged["categories"].get(value, 0) + count
+    return merged
+
+################################################################################
+# 2 Stream one Arrow file
+################################################################################
+def profile_file(path):
+    summaries = {}
+    with pa.memory_map(str(path), "r") as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = type_columns(pa.Table.from_batches([reader.get_batch(i)]))
+            for name in batch.column_names:
+                if name == "patient_id":
+                    continue
+                column = batch.column(name).combine_chunks()
+                if name not in summaries:
+                    summaries[name] = new_summary(column_kind(column.type))
+                update_summary(summaries[name], column)
+    return summaries
+
+################################################################################
+# 3 Data properties, with counts as they are or rounded to midpoint6
+################################################################################
+def fn_roundmid_any(x, to=1):
+    return math.ceil(x / to) * to - (to // 2) * (x != 0)
+
+def as_output(value, kind, coarse=False):
+    if value is None or not math.isfinite(value):
+        return ""
+    if kind == "date":
+        date = (datetime.date(1970, 1, 1) + datetime.timedelta(days=round(value))).isoformat()
+        return date[:7] if coarse else date
+    return round(value, 1 if coarse else 2)
+
+def variable_rows(summaries, rounded):
+    count = (lambda x: fn_roundmid_any(x, threshold)) if rounded else (lambda x: x)
+    rows = []
+    for name, summary in summaries.items():
+        kind = summary["kind"]
+        row = {"variable": name, "kind": kind, "n": count(summary["n"]), "n_missing": count(summary["n_missing"])}
+        if kind in ("date", "num"):
+            n_values = summary["n"] - summary["n_missing"]
+            statistics = dict(zip(quantiles, sketch_quantiles(summary["levels"])))
+            if not rounded:
+                row.update({"min": as_output(summary["min"], kind), "max": as_output(summary["max"], kind)})
+                row["mean"] = as_output(summary["sum"] / n_values, kind) if n_values else ""
+                for q, value in statistics.items():
+                    row[f"p{round(q * 100)}"] = as_output(value, kind)
+            else:
+                released = count(n_values) >= min_released_n
+                row["mean"] = as_output(summary["sum"] / n_values, kind, coarse=True) if released else ""
+                for q in released_quantiles:
+                    row[f"p{round(q * 100)}"] = as_output(statistics[q], kind, coarse=True) if released else ""
+        elif kind == "bin":
+            row.update({"n_true": count(summary["n_true"]), "n_false": count(summary["n"] - summary["n_missing"] - summary["n_true"])})
+        rows.append(row)
+    return rows
+
+def category_rows(summaries, rounded):
+    count = (lambda x: fn_roundmid_any(x, threshold)) if rounded else (lambda x: x)
+    return [
+        {"variable": name, "category": value, "n": count(n)}
+        for name, summary in summaries.items() if summary["kind"] == "cat"
+        for value, n in sorted(summary["categories"].items(), key=lambda item: str(item[0]))
+    ]
+
+def write_csv(rows, path):
+    fields = list(dict.fromkeys(field for row in rows for field in row))
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+################################################################################
+# 4 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", nargs="+", default=["output/dataset.arrow"], help="Arrow file(s), e.g. the shards of a sharded extraction")
+    parser.add_argument("--output-dir", default="output/data_properties/profile")
+    args = parser.parse_args()
+
+    summaries = {}
+    for path in args.input:
+        for name, summary in profile_file(path).items():
+            summaries[name] = merge_summaries(summaries[name], summary) if name in summaries else summary
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for rounded, suffix in [(False, ""), (True, "_midpoint6")]:
+        write_csv(variable_rows(summaries, rounded), output_dir / f"profile_variables{suffix}.csv")
+        write_csv(category_rows(summaries, rounded), output_dir / f"profile_categories{suffix}.csv")
+    print(f"profiled {len(summaries)} variables in {len(args.input)} file(s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+################################################################################
+## This script does the following:
+# 1. Load analysis/dataset_definition.py with every `dataset.<name> = ...` assignment
+#    (and define_population) wrapped, recording each variable's query graph; the time
+#    to build the whole definition is reported as a total only (variables are built
+#    ahead of their assignment, e.g. in variables_at(), so it cannot be split by them)
+# 2. Per variable: query-graph node count, source tables touched, number of filters,
+#    sorts and table scans
+# 3. Per source table: how many distinct scans the whole dataset needs, and which
+#    variables and helper functions (variable_helper_functions.py) they come from
+# 4. Save output/dataset_scan_report.json and output/dataset_table_scans.csv, next
+#    to output/dataset.arrow
+#
+# A "scan" is one distinct per-patient aggregation (first/last row, exists, count,
+# min/max, ...) over an event or patient table. Identical aggregations are evaluated
+# once by ehrQL, so they are counted once. Needs ehrQL installed (e.g. the codespace):
+#   python analysis/query_report.py
+################################################################################
+import argparse
+import csv
+import dataclasses
+import json
+import runpy
+import sys
+import time
+from collections import defaultdict
+
+from ehrql.query_language import Dataset
+from ehrql.query_model.nodes import Node
+
+import variable_helper_functions
+
+################################################################################
+# 0 Query-graph walking
+################################################################################
+def child_nodes(node):
+    for field in dataclasses.fields(node):
+        yield from nodes_in(getattr(node, field.name))
+
+def nodes_in(value):
+    if isinstance(value, Node):
+        yield value
+    elif isinstance(value, (tuple, list, frozenset, set)):
+        for item in value:
+            if isinstance(item, (Node, tuple, list, frozenset, set, dict)):
+                yield from nodes_in(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from nodes_in(item)
+
+def all_nodes(node):
+    seen, stack = set(), [node]
+    while stack:
+        node = stack.pop()
+        if node not in seen:
+            seen.add(node)
+            stack.extend(child_nodes(node))
+    return seen
+
+def is_table(node):
+    return type(node).__name__ in ("SelectTable", "SelectPatientTable")
+
+def is_aggregation(node):
+    return type(node).__name__ == "PickOneRowPerPatient" or type(node).__qualname__.startswith("AggregateByPatient.")
+
+# tables read by one aggregation itself, not through nested aggregations (e.g. the cohort)
+def scanned_tables(aggregation):
+    tables, seen, stack = set(), set(), list(child_nodes(aggregation))
+    while stack:
+        node = stack.pop()
+        if node in seen or is_aggregation(node):
+            continue
+        seen.add(node)
+        if is_table(node):
+            tables.add(node.name)
+        stack.extend(child_nodes(node))
+    return tables
+
+def result_nodes(result):
+    if hasattr(result, "_qm_node"):
+        return [result._qm_node]
+    if isinstance(result, dict):
+        return [node for item in result.values() for node in result_nodes(item)]
+    if isinstance(result, (list, tuple)):
+        return [node for item in result for node in result_nodes(item)]
+    return []
+
+################################################################################
+# 1 Load the dataset definition with the assignments wrapped
+################################################################################
+# params: the dataset definition parameters (what follows `--` in project.yaml)
+def load_variables(definition, params=()):
+    variables = {}
+    original_setattr = Dataset.__setattr__
+    original_define_population = Dataset.define_population
+
+    def record(name, value):
+        variables[name] = {"node": value._qm_node}
+
+    def wrapped_setattr(self, name, value):
+        if hasattr(value, "_qm_node"):
+            record(name, value)
+        original_setattr(self, name, value)
+
+    def wrapped_define_population(self, population_condition):
+        record("population", population_condition)
+        original_define_population(self, population_condition)
+
+    Dataset.__setattr__ = wrapped_setattr
+    Dataset.define_population = wrapped_define_population
+    argv = sys.argv
+    sys.argv = [definition, *params]
+    try:
+        namespace = runpy.run_path(definition, run_name="dataset_definition")
+    finally:
+        sys.argv = argv
+        Dataset.__setattr__ = original_setattr
+        Dataset.define_population = original_define_population
+    return variables, namespace
+
+################################################################################
+# 2 Per-variable and per-table report
+################################################################################
+def build_report(variables, helper_cache):
+    helper_of = {}
+    for key, result in helper_cache.items():
+        for node in result_nodes(result):
+            for aggregation in filter(is_aggregation, all_nodes(node)):
+                helper_of.setdefault(aggregation, key[0])
+
+    report = {"variables": {}, "tables": {}}
+    scans = defaultdict(lambda: {"scans": set(), "variables": set(), "helpers": set()})
+    for name, variable in variables.items():
+        nodes = all_nodes(variable["node"])
+        aggregations = [node for node in nodes if is_aggregation(node) and scanned_tables(node)]
+        tables = set()
+        for aggregation in aggregations:
+            for table in scanned_tables(aggregation):
+                tables.add(table)
+                scans[table]["scans"].add(aggregation)
+                scans[table]["variables"].add(name)
+                scans[table]["helpers"].add(helper_of.get(aggregation, "inline"))
+        report["variables"][name] = {
+            "n_nodes": len(nodes),
+            "tables": sorted(tables),
+            "n_filters": sum(type(node).__name__ == "Filter" for node in nodes),
+            "n_sorts": sum(type(node).__name__ == "Sort" for node in nodes),
+            "n_scans": len(aggregations),
+        }
+    for table, scan in sorted(scans.items()):
+        report["tables"][table] = {
+            "n_scans": len(scan["scans"]),
+            "variables": sorted(scan["variables"]),
+            "helpers": sorted(scan["helpers"]),
+        }
+    return report
+
+################################################################################
+# 3 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--definition", default="analysis/dataset_definition.py")
+    parser.add_argument("--output-dir", default="output")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    variables, namespace = load_variables(args.definition)
+    build_seconds = time.perf_counter() - start
+    # only Dataset._compile() (variables to query-model nodes), not the query engine's
+    # own compilation to SQL or the extraction run by generate-dataset
+    start = time.perf_counter()
+    namespace["dataset"]._compile()
+    dataset_compile_seconds = time.perf_counter() - start
+
+    report = build_report(variables, variable_helper_functions.helper_cache)
+    report["build_seconds"] = round(build_seconds, 4)
+    report["dataset_compile_seconds"] = round(dataset_compile_seconds, 4)
+
+    with open(f"{args.output_dir}/dataset_scan_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(f"{args.output_dir}/dataset_table_scans.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["table", "n_scans", "variables", "helpers"])
+        for table, scan in report["tables"].items():
+            writer.writerow([table, scan["n_scans"], ";".join(scan["variables"]), ";".join(scan["helpers"])])
+    for table, scan in report["tables"].items():
+        print(f"{table}: {scan['n_scans']} scans")
+
+if __name__ == "__main__":
+    main()
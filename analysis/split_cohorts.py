@@ -0,0 +1,85 @@
+################################################################################
+## This script does the following:
+# 1. Import output/dataset_cohorts.arrow, extracted with `-- --cohorts` (one run for
+#    all cohorts of analysis/cohorts.py)
+# 2. Per cohort: keep the patients flagged in cohort_bin_<cohort>, and the columns of
+#    its index date under the standard names of dataset.arrow (exposure date as
+#    exp_date_bari_index, index-date variables and outcomes without their _<index>
+#    suffix). Cohorts on another index than the primary one drop the columns anchored
+#    at the primary index (primary_index_columns)
+# 3. Save output/cohorts/dataset_<cohort>.arrow
+################################################################################
+import argparse
+from pathlib import Path
+
+import pyarrow as pa
+
+from arrow_helper_functions import (
+    read_arrow,
+    write_arrow,
+)
+from cohorts import cohorts, index_dates, primary_index
+
+################################################################################
+# 1 Columns: shared by all cohorts, or specific to one index date
+################################################################################
+# measured from the first hospitalised-with treatment in the study period, i.e. the
+# primary index: wrong for any other index date
+primary_index_columns = [
+    "exp_date_bari_hosp_second",
+    "exp_date_bari_hosp_third",
+    "cov_status_bari_hosp_first",
+]
+
+def index_variable_names(column_names):
+    suffixes = [f"_{index}" for index in index_dates if index != primary_index]
+    return sorted({
+        name[:-len(suffix)]
+        for name in column_names
+        for suffix in suffixes
+        if name.endswith(suffix) and name[:-len(suffix)] in column_names
+    })
+
+def is_cohort_column(name):
+    if name.startswith("cohort_bin_") or name in {f"exp_date_bari_{index}" for index in index_dates}:
+        return True
+    return any(name.endswith(f"_{index}") for index in index_dates if index != primary_index)
+
+################################################################################
+# 2 One cohort
+################################################################################
+def cohort_dataset(table, name, index_names):
+    index = cohorts[name]["index"]
+    table = table.filter(table.column(f"cohort_bin_{name}"))
+    columns = {"patient_id": table.column("patient_id"), "exp_date_bari_index": table.column(f"exp_date_bari_{index}")}
+    for column_name in table.column_names:
+        if column_name == "patient_id" or is_cohort_column(column_name):
+            continue
+        if column_name in primary_index_columns and index != primary_index:
+            continue
+        if column_name in index_names and index != primary_index:
+            columns[column_name] = table.column(f"{column_name}_{index}")
+        else:
+            columns[column_name] = table.column(column_name)
+    return pa.table(columns)
+
+################################################################################
+# 3 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/dataset_cohorts.arrow")
+    parser.add_argument("--output-dir", default="output/cohorts")
+    args = parser.parse_args()
+
+    table = read_arrow(args.input)
+    index_names = index_variable_names(table.column_names)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name in cohorts:
+        cohort = cohort_dataset(table, name, index_names)
+        write_arrow(cohort, output_dir / f"dataset_{name}.arrow")
+        print(f"{name}: {cohort.num_rows} patients")
+
+if __name__ == "__main__":
+    main()
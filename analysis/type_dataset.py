@@ -0,0 +1,101 @@
+################################################################################
+## This script does the following:
+# 1. Import output/dataset.arrow (memory-mapped)
+# 2. Give every column its final type from the variable naming convention of
+#    dataset_definition.py, with the same rules (and precedence) as fn_extract_data.R:
+#    _date -> date32, birth_year -> integer year, _num -> integer (floats stay float),
+#    _cat -> dictionary with sorted levels (factor in R), _bin -> bool
+# 3. Save output/dataset_typed.arrow as chunked record batches, so data_process.R
+#    can memory-map it and read it without re-casting any column
+################################################################################
+import argparse
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from arrow_helper_functions import read_arrow
+
+batch_size = 65536
+
+################################################################################
+# 0 Casts, applied in this order to every column whose name contains the pattern
+################################################################################
+def as_date(column):
+    return column.cast(pa.date32())
+
+def as_year(column):
+    if pa.types.is_integer(column.type):
+        return column
+    return pc.year(column.cast(pa.date32())).cast(pa.int16())
+
+def as_number(column):
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        return column
+    if pa.types.is_boolean(column.type):
+        return column.cast(pa.int8())
+    return column.cast(pa.float64())
+
+# levels sorted as R's as.factor() sorts them: numerically for numbers, lexically (by
+# byte, as R in the C locale) for strings, not in order of first appearance as
+# pc.dictionary_encode would; a column
+# that already is a dictionary (an ehrQL category) keeps its levels, as in R
+def as_category(column):
+    if pa.types.is_dictionary(column.type):
+        return column
+    levels = pc.drop_null(pc.unique(column))
+    levels = levels.take(pc.sort_indices(levels))
+    indices = pc.index_in(column, value_set=levels).cast(pa.int32())
+    levels = levels.cast(pa.string())
+    return pa.chunked_array(
+        [pa.DictionaryArray.from_arrays(chunk, levels) for chunk in indices.chunks],
+        type=pa.dictionary(pa.int32(), pa.string()),
+    )
+
+def as_logical(column):
+    return column.cast(pa.bool_())
+
+column_types = [
+    ("_date", as_date),
+    ("birth_year", as_year),
+    ("_num", as_number),
+    ("_cat", as_category),
+    ("_bin", as_logical),
+]
+
+################################################################################
+# 1 Type all columns
+################################################################################
+def type_columns(table):
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name)
+        for pattern, cast in column_types:
+            if pattern in name:
+                column = cast(column)
+        columns[name] = column
+    return pa.table(columns)
+
+def write_batches(table, path):
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=batch_size):
+                writer.write_batch(batch)
+
+################################################################################
+# 2 Run
+################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/dataset.arrow")
+    parser.add_argument("--output", default="output/dataset_typed.arrow")
+    args = parser.parse_args()
+
+    table = type_columns(read_arrow(args.input))
+    # one dictionary per categorical column across all batches
+    table = table.unify_dictionaries().combine_chunks()
+    write_batches(table, args.output)
+    for field in table.schema:
+        print(f"{field.name}: {field.type}")
+
+if __name__ == "__main__":
+    main()
@@ -9,43 +9,133 @@ from ehrql.tables.tpp import (
     ons_deaths,
     emergency_care_attendances,
     patients,
-    covid_therapeutics
+    covid_therapeutics,
+    addresses,
+    practice_registrations
 )
 from ehrql import days # for BMI function
 from ehrql.codes import CTV3Code # for BMI function
 
 ### HELPER functions, based on https://github.com/opensafely/comparative-booster-spring2023/blob/main/analysis/dataset_definition.py
 import operator
-from functools import reduce
+from functools import reduce, wraps
+from collections import Counter
 def any_of(conditions):
-    return reduce(operator.or_, conditions)
+    # combined pairwise, so the OR tree is balanced (depth log2(n)) instead of left-leaning
+    conditions = list(conditions)
+    while len(conditions) > 1:
+        conditions = [reduce(operator.or_, conditions[i:i + 2]) for i in range(0, len(conditions), 2)]
+    return conditions[0]
+
+### CACHE of helper calls: structurally identical calls return the same frame
+# This only saves repeated Python calls (building the same query graph again): ehrQL
+# already evaluates structurally identical query nodes once, so the cache does not
+# change the generated queries or the number of table scans (see analysis/query_report.py
+# for those). ehrQL series overload == and are not hashable, so they are keyed by their
+# query node. Codelists are keyed as sorted, deduplicated code tuples (order does not
+# matter for is_in). The dataset definition clears the cache when it is loaded, so a
+# process loading it several times (runpy in query_report.py) starts empty each time.
+helper_cache = {}
+helper_cache_hits = Counter()
+def clear_helper_cache():
+    helper_cache.clear()
+    helper_cache_hits.clear()
+def cache_key(value):
+    if hasattr(value, "_qm_node"):
+        return ("node", value._qm_node)
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted((key, cache_key(item)) for key, item in value.items())))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return ("codes", tuple(sorted(set(value), key=str)))
+    return ("value", value)
+def cached(helper):
+    @wraps(helper)
+    def wrapper(*args, **kwargs):
+        try:
+            key = (helper.__name__, tuple(cache_key(arg) for arg in args), cache_key(kwargs))
+            hash(key)
+        except TypeError: # unhashable argument, nothing to share
+            return helper(*args, **kwargs)
+        if key in helper_cache:
+            helper_cache_hits[helper.__name__] += 1
+        else:
+            helper_cache[key] = helper(*args, **kwargs)
+        return helper_cache[key]
+    return wrapper
+def helper_cache_report():
+    lines = [
+        f"helper cache: {len(helper_cache)} distinct helper calls, {sum(helper_cache_hits.values())} repeated Python calls reused "
+        "(ehrQL dedupes identical queries itself: this does not change the queries or table scans)"
+    ]
+    for helper, hits in helper_cache_hits.most_common():
+        lines.append(f"  {helper}: {hits} repeated calls reused")
+    return "\n".join(lines)
+
+#######################################################################################
+### COHORT restriction (two-stage extraction)
+#######################################################################################
+# Stage 1: the dataset definition materialises the exposed cohort. Stage 2: it passes
+# that condition to every helper below as cohort=..., so the helper only scans the event
+# rows of patients in the cohort instead of the whole TPP population. The default
+# (cohort=True) scans everyone. The cohort is part of the cache key like any argument.
+def in_cohort(frame, cohort=True):
+    return frame.where(cohort)
+
+#######################################################################################
+### ANY of several diagnosis columns is in codelist
+#######################################################################################
+emergency_care_diagnosis_columns = [f"diagnosis_{i:02d}" for i in range(1, 25)]
+# The codelist is deduplicated once and, through the cache, the condition is built only
+# once per table and codelist, however many helpers use it.
+@cached
+def any_column_is_in(table, column_names, codelist):
+    codes = sorted(set(codelist))
+    return any_of([getattr(table, column_name).is_in(codes) for column_name in column_names])
+
+#######################################################################################
+### SNAPSHOT on a date: the one active row per patient, for all of its columns
+#######################################################################################
+# Resolved once per date (through the cache), so each variable read from it is a
+# column of the same as-of row instead of a separate as-of lookup.
+@cached
+def address_snapshot_on(date, cohort=True):
+    return in_cohort(addresses, cohort).for_patient_on(date)
+@cached
+def registration_snapshot_on(date, cohort=True):
+    return in_cohort(practice_registrations, cohort).for_patient_on(date)
 
 #######################################################################################
 ### ANY HISTORY of ... and give latest ... (including baseline_date) 
 #######################################################################################
 ## In PRIMARY CARE
 # CTV3/Read
-def last_matching_event_clinical_ctv3_before(codelist, baseline_date, where=True):
+@cached
+def last_matching_event_clinical_ctv3_before(codelist, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_before(baseline_date))
         .sort_by(clinical_events.date)
         .last_for_patient()
     )
 # Snomed
-def last_matching_event_clinical_snomed_before(codelist, baseline_date, where=True):
+@cached
+def last_matching_event_clinical_snomed_before(codelist, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.snomedct_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_before(baseline_date))
         .sort_by(clinical_events.date)
         .last_for_patient()
     )
 # Medication
-def last_matching_med_dmd_before(codelist, baseline_date, where=True):
+@cached
+def last_matching_med_dmd_before(codelist, baseline_date, where=True, cohort=True):
     return(
         medications.where(where)
+        .where(cohort)
         .where(medications.dmd_code.is_in(codelist))
         .where(medications.date.is_on_or_before(baseline_date))
         .sort_by(medications.date)
@@ -53,9 +143,11 @@ def last_matching_med_dmd_before(codelist, baseline_date, where=True):
     )
 
 ## In SECONDARY CARE (Hospital Episodes)
-def last_matching_event_apc_before(codelist, baseline_date, where=True):
+@cached
+def last_matching_event_apc_before(codelist, baseline_date, where=True, cohort=True):
     return(
         apcs.where(where)
+        .where(cohort)
         .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
         .where(apcs.admission_date.is_on_or_before(baseline_date))
         .sort_by(apcs.admission_date)
@@ -63,9 +155,11 @@ def last_matching_event_apc_before(codelist, baseline_date, where=True):
     )
 
 ## In OUTPATIENT CARE
-def last_matching_event_opa_before(codelist, baseline_date, where=True):
+@cached
+def last_matching_event_opa_before(codelist, baseline_date, where=True, cohort=True):
     return(
         opa_diag.where(where)
+        .where(cohort)
         .where(opa_diag.primary_diagnosis_code.is_in(codelist) | opa_diag.secondary_diagnosis_code_1.is_in(codelist))
         .where(opa_diag.appointment_date.is_on_or_before(baseline_date))
         .sort_by(opa_diag.appointment_date)
@@ -73,53 +167,54 @@ def last_matching_event_opa_before(codelist, baseline_date, where=True):
     )
 
 ## In EMERGENCY CARE
-def last_matching_event_ec_snomed_before(codelist, baseline_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
+@cached
+def last_matching_event_ec_snomed_before(codelist, baseline_date, where=True, cohort=True):
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(cohort)
+        .where(any_column_is_in(emergency_care_attendances, emergency_care_diagnosis_columns, codelist))
         .where(emergency_care_attendances.arrival_date.is_before(baseline_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .last_for_patient()
     )
 
 ## DEATH
+@cached
 def matching_death_before(codelist, baseline_date, where=True):
-    conditions = [
-        getattr(ons_deaths, column_name).is_in(codelist)
-        for column_name in (["underlying_cause_of_death"]+[f"cause_of_death_{i:02d}" for i in range(1, 16)])
-    ]
-    return any_of(conditions) & ons_deaths.date.is_before(baseline_date)
+    return ons_deaths.cause_of_death_is_in(codelist) & ons_deaths.date.is_before(baseline_date)
 
 #######################################################################################
 ### HISTORY of ... in past ... days/months/years ... and give latest (including baseline_date)
 #######################################################################################
 ## In PRIMARY CARE
 # CTV3/Read
-def last_matching_event_clinical_ctv3_between(codelist, start_date, baseline_date, where=True):
+@cached
+def last_matching_event_clinical_ctv3_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_between(start_date, baseline_date))
         .sort_by(clinical_events.date)
         .last_for_patient()
     )
 # Snomed
-def last_matching_event_clinical_snomed_between(codelist, start_date, baseline_date, where=True):
+@cached
+def last_matching_event_clinical_snomed_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.snomedct_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_between(start_date, baseline_date))
         .sort_by(clinical_events.date)
         .last_for_patient()
     )
 # Medication
-def last_matching_med_dmd_between(codelist, start_date, baseline_date, where=True):
+@cached
+def last_matching_med_dmd_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         medications.where(where)
+        .where(cohort)
         .where(medications.dmd_code.is_in(codelist))
         .where(medications.date.is_on_or_between(start_date, baseline_date))
         .sort_by(medications.date)
@@ -127,9 +222,11 @@ def last_matching_med_dmd_between(codelist, start_date, baseline_date, where=Tru
     )
 
 ## In SECONDARY CARE (Hospital Episodes)
-def last_matching_event_apc_between(codelist, start_date, baseline_date, where=True):
+@cached
+def last_matching_event_apc_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         apcs.where(where)
+        .where(cohort)
         .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
         .where(apcs.admission_date.is_on_or_between(start_date, baseline_date))
         .sort_by(apcs.admission_date)
@@ -137,9 +234,11 @@ def last_matching_event_apc_between(codelist, start_date, baseline_date, where=T
     )
 
 ## In OUTPATIENT CARE
-def last_matching_event_opa_between(codelist, start_date, baseline_date, where=True):
+@cached
+def last_matching_event_opa_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         opa_diag.where(where)
+        .where(cohort)
         .where(opa_diag.primary_diagnosis_code.is_in(codelist) | opa_diag.secondary_diagnosis_code_1.is_in(codelist))
         .where(opa_diag.appointment_date.is_on_or_between(start_date, baseline_date))
         .sort_by(opa_diag.appointment_date)
@@ -147,14 +246,12 @@ def last_matching_event_opa_between(codelist, start_date, baseline_date, where=T
     )
 
 ## In EMERGENCY CARE
-def last_matching_event_ec_snomed_between(codelist, start_date, baseline_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
+@cached
+def last_matching_event_ec_snomed_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(cohort)
+        .where(any_column_is_in(emergency_care_attendances, emergency_care_diagnosis_columns, codelist))
         .where(emergency_care_attendances.arrival_date.is_on_or_between(start_date, baseline_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .last_for_patient()
@@ -165,35 +262,43 @@ def last_matching_event_ec_snomed_between(codelist, start_date, baseline_date, w
 #######################################################################################
 ## In PRIMARY CARE
 # CTV3/Read
-def count_matching_event_clinical_ctv3_before(codelist, baseline_date, where=True):
+@cached
+def count_matching_event_clinical_ctv3_before(codelist, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_before(baseline_date))
         .count_for_patient()
     )
 # Snomed
-def count_matching_event_clinical_snomed_before(codelist, baseline_date, where=True):
+@cached
+def count_matching_event_clinical_snomed_before(codelist, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.snomedct_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_before(baseline_date))
         .count_for_patient()
     )
 
 ## In SECONDARY CARE (Hospital Episodes)
-def count_matching_event_apc_before(codelist, baseline_date, where=True):
+@cached
+def count_matching_event_apc_before(codelist, baseline_date, where=True, cohort=True):
     return(
         apcs.where(where)
+        .where(cohort)
         .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
         .where(apcs.admission_date.is_on_or_before(baseline_date))
         .count_for_patient()
     )
 
 ## In OUTPATIENT CARE
-def count_matching_event_opa_before(codelist, baseline_date, where=True):
+@cached
+def count_matching_event_opa_before(codelist, baseline_date, where=True, cohort=True):
     return(
         opa_diag.where(where)
+        .where(cohort)
         .where(opa_diag.primary_diagnosis_code.is_in(codelist) | opa_diag.secondary_diagnosis_code_1.is_in(codelist))
         .where(opa_diag.appointment_date.is_on_or_before(baseline_date))
         .count_for_patient()
@@ -204,66 +309,153 @@ def count_matching_event_opa_before(codelist, baseline_date, where=True):
 #######################################################################################
 ## In PRIMARY CARE
 # CTV3/Read
-def count_matching_event_clinical_ctv3_between(codelist, start_date, baseline_date, where=True):
+@cached
+def count_matching_event_clinical_ctv3_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_between(start_date, baseline_date))
         .count_for_patient()
     )
 # Snomed
-def count_matching_event_clinical_snomed_between(codelist, start_date, baseline_date, where=True):
+@cached
+def count_matching_event_clinical_snomed_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.snomedct_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_between(start_date, baseline_date))
         .count_for_patient()
     )
 
 ## In SECONDARY CARE (Hospital Episodes)
-def count_matching_event_apc_between(codelist, start_date, baseline_date, where=True):
+@cached
+def count_matching_event_apc_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         apcs.where(where)
+        .where(cohort)
         .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
         .where(apcs.admission_date.is_on_or_between(start_date, baseline_date))
         .count_for_patient()
     )
 
 ## In OUTPATIENT CARE
-def count_matching_event_opa_between(codelist, start_date, baseline_date, where=True):
+@cached
+def count_matching_event_opa_between(codelist, start_date, baseline_date, where=True, cohort=True):
     return(
         opa_diag.where(where)
+        .where(cohort)
         .where(opa_diag.primary_diagnosis_code.is_in(codelist) | opa_diag.secondary_diagnosis_code_1.is_in(codelist))
         .where(opa_diag.appointment_date.is_on_or_between(start_date, baseline_date))
         .count_for_patient()
     )
 
+#######################################################################################
+### SEVERAL look-back windows from ONE filtered set of events (including baseline_date)
+#######################################################################################
+# date_column: name of the event date column. windows: look-back periods in days before
+# baseline_date, or "ever" (no lower limit).
+# Returns {window: {"first_date", "last_date", "exists", "count"}}, all derived from the
+# same codelist and date filter on the source table.
+def events_in_windows(events, date_column, baseline_date, windows):
+    events = events.where(getattr(events, date_column).is_on_or_before(baseline_date))
+    results = {}
+    for window in windows:
+        if window == "ever":
+            in_window = events
+        else:
+            in_window = events.where(getattr(events, date_column).is_on_or_after(baseline_date - days(window)))
+        dates = getattr(in_window, date_column)
+        results[window] = {
+            "first_date": dates.minimum_for_patient(),
+            "last_date": dates.maximum_for_patient(),
+            "exists": in_window.exists_for_patient(),
+            "count": in_window.count_for_patient(),
+        }
+    return results
+
+## In PRIMARY CARE
+# CTV3/Read
+@cached
+def matching_event_clinical_ctv3_windows(codelist, baseline_date, windows, where=True, cohort=True):
+    events = (
+        clinical_events.where(where)
+        .where(cohort)
+        .where(clinical_events.ctv3_code.is_in(codelist))
+    )
+    return events_in_windows(events, "date", baseline_date, windows)
+# Snomed
+@cached
+def matching_event_clinical_snomed_windows(codelist, baseline_date, windows, where=True, cohort=True):
+    events = (
+        clinical_events.where(where)
+        .where(cohort)
+        .where(clinical_events.snomedct_code.is_in(codelist))
+    )
+    return events_in_windows(events, "date", baseline_date, windows)
+# Medication
+@cached
+def matching_med_dmd_windows(codelist, baseline_date, windows, where=True, cohort=True):
+    events = (
+        medications.where(where)
+        .where(cohort)
+        .where(medications.dmd_code.is_in(codelist))
+    )
+    return events_in_windows(events, "date", baseline_date, windows)
+
+## In SECONDARY CARE (Hospital Episodes)
+@cached
+def matching_event_apc_windows(codelist, baseline_date, windows, where=True, cohort=True):
+    events = (
+        apcs.where(where)
+        .where(cohort)
+        .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
+    )
+    return events_in_windows(events, "admission_date", baseline_date, windows)
+
+## In OUTPATIENT CARE
+@cached
+def matching_event_opa_windows(codelist, baseline_date, windows, where=True, cohort=True):
+    events = (
+        opa_diag.where(where)
+        .where(cohort)
+        .where(opa_diag.primary_diagnosis_code.is_in(codelist) | opa_diag.secondary_diagnosis_code_1.is_in(codelist))
+    )
+    return events_in_windows(events, "appointment_date", baseline_date, windows)
+
 #######################################################################################
 ### ANY HISTORY of ... and give first ... (including baseline_date) 
 #######################################################################################
 ## In PRIMARY CARE
 # CTV3/Read
-def first_matching_event_clinical_ctv3_before(codelist, baseline_date, where=True):
+@cached
+def first_matching_event_clinical_ctv3_before(codelist, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_before(baseline_date))
         .sort_by(clinical_events.date)
         .first_for_patient()
     )
 # Snomed
-def first_matching_event_clinical_snomed_before(codelist, baseline_date, where=True):
+@cached
+def first_matching_event_clinical_snomed_before(codelist, baseline_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.snomedct_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_before(baseline_date))
         .sort_by(clinical_events.date)
         .first_for_patient()
     )
 # Medication
-def first_matching_med_dmd_before(codelist, baseline_date, where=True):
+@cached
+def first_matching_med_dmd_before(codelist, baseline_date, where=True, cohort=True):
     return(
         medications.where(where)
+        .where(cohort)
         .where(medications.dmd_code.is_in(codelist))
         .where(medications.date.is_on_or_before(baseline_date))
         .sort_by(medications.date)
@@ -271,9 +463,11 @@ def first_matching_med_dmd_before(codelist, baseline_date, where=True):
     )
 
 ## In SECONDARY CARE (Hospital Episodes)
-def first_matching_event_apc_before(codelist, baseline_date, where=True):
+@cached
+def first_matching_event_apc_before(codelist, baseline_date, where=True, cohort=True):
     return(
         apcs.where(where)
+        .where(cohort)
         .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
         .where(apcs.admission_date.is_on_or_before(baseline_date))
         .sort_by(apcs.admission_date)
@@ -281,14 +475,12 @@ def first_matching_event_apc_before(codelist, baseline_date, where=True):
     )
 
 ## In EMERGENCY CARE
-def first_matching_event_ec_snomed_before(codelist, baseline_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
+@cached
+def first_matching_event_ec_snomed_before(codelist, baseline_date, where=True, cohort=True):
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(cohort)
+        .where(any_column_is_in(emergency_care_attendances, emergency_care_diagnosis_columns, codelist))
         .where(emergency_care_attendances.arrival_date.is_before(baseline_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .first_for_patient()
@@ -298,48 +490,78 @@ def first_matching_event_ec_snomed_before(codelist, baseline_date, where=True):
 ### Any future events (including baseline_date and study end_date)
 #######################################################################################
 ## In COVID Therapeutics dataset
-def first_matching_event_bari_between(setting, baseline_date, end_date, where=True):
+@cached
+def first_matching_event_bari_between(setting, baseline_date, end_date, where=True, cohort=True):
     return(
         covid_therapeutics.where(where)
+        .where(cohort)
         .where(covid_therapeutics.intervention.is_in(["Baricitinib"]))
         .where(covid_therapeutics.covid_indication.is_in([setting]))
         .where(covid_therapeutics.treatment_start_date.is_on_or_between(baseline_date, end_date))
         .sort_by(covid_therapeutics.treatment_start_date)
         .first_for_patient()
     )
-def last_matching_event_bari_between(setting, baseline_date, end_date, where=True):
+@cached
+def last_matching_event_bari_between(setting, baseline_date, end_date, where=True, cohort=True):
     return(
         covid_therapeutics.where(where)
+        .where(cohort)
         .where(covid_therapeutics.intervention.is_in(["Baricitinib"]))
         .where(covid_therapeutics.covid_indication.is_in([setting]))
         .where(covid_therapeutics.treatment_start_date.is_on_or_between(baseline_date, end_date))
         .sort_by(covid_therapeutics.treatment_start_date)
         .last_for_patient()
     )
+# 1st..Kth treatment: a list of K one-row-per-patient frames (treatment_start_date, 
+# current_status, ...). All ranks come from the same filtered treatments; rank k+1 is the 
+# first treatment with a start date strictly after rank k.
+# ehrQL cannot rank rows in one pass (there is no row-number / nth_for_patient), so this is
+# still K dependent queries, each one filtering on the result of the previous rank: the
+# cost grows with K. Callers should only ask for the ranks they actually use.
+@cached
+def ranked_matching_events_bari_between(setting, baseline_date, end_date, k, where=True, cohort=True):
+    treatments = (
+        covid_therapeutics.where(where)
+        .where(cohort)
+        .where(covid_therapeutics.intervention.is_in(["Baricitinib"]))
+        .where(covid_therapeutics.covid_indication.is_in([setting]))
+        .where(covid_therapeutics.treatment_start_date.is_on_or_between(baseline_date, end_date))
+    )
+    ranked = [treatments.sort_by(treatments.treatment_start_date).first_for_patient()]
+    for _ in range(k - 1):
+        later = treatments.where(treatments.treatment_start_date.is_after(ranked[-1].treatment_start_date))
+        ranked.append(later.sort_by(later.treatment_start_date).first_for_patient())
+    return ranked
 
 ## In PRIMARY CARE
 # CTV3/Read
-def first_matching_event_clinical_ctv3_between(codelist, baseline_date, end_date, where=True):
+@cached
+def first_matching_event_clinical_ctv3_between(codelist, baseline_date, end_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_between(baseline_date, end_date))
         .sort_by(clinical_events.date)
         .first_for_patient()
     )
 # Snomed
-def first_matching_event_clinical_snomed_between(codelist, baseline_date, end_date, where=True):
+@cached
+def first_matching_event_clinical_snomed_between(codelist, baseline_date, end_date, where=True, cohort=True):
     return(
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.snomedct_code.is_in(codelist))
         .where(clinical_events.date.is_on_or_between(baseline_date, end_date))
         .sort_by(clinical_events.date)
         .first_for_patient()
     )
 # Medication
-def first_matching_med_dmd_between(codelist, baseline_date, end_date, where=True):
+@cached
+def first_matching_med_dmd_between(codelist, baseline_date, end_date, where=True, cohort=True):
     return(
         medications.where(where)
+        .where(cohort)
         .where(medications.dmd_code.is_in(codelist))
         .where(medications.date.is_on_or_between(baseline_date, end_date))
         .sort_by(medications.date)
@@ -347,9 +569,11 @@ def first_matching_med_dmd_between(codelist, baseline_date, end_date, where=True
     )
 
 ## In SECONDARY CARE
-def first_matching_event_apc_between(codelist, baseline_date, end_date, where=True):
+@cached
+def first_matching_event_apc_between(codelist, baseline_date, end_date, where=True, cohort=True):
     return(
         apcs.where(where)
+        .where(cohort)
         .where(apcs.primary_diagnosis.is_in(codelist) | apcs.secondary_diagnosis.is_in(codelist))
         .where(apcs.admission_date.is_on_or_between(baseline_date, end_date))
         .sort_by(apcs.admission_date)
@@ -357,9 +581,11 @@ def first_matching_event_apc_between(codelist, baseline_date, end_date, where=Tr
     )
 
 ## In OUTPATIENT CARE
-def first_matching_event_opa_between(codelist, baseline_date, end_date, where=True):
+@cached
+def first_matching_event_opa_between(codelist, baseline_date, end_date, where=True, cohort=True):
     return(
         opa_diag.where(where)
+        .where(cohort)
         .where(opa_diag.primary_diagnosis_code.is_in(codelist) | opa_diag.secondary_diagnosis_code_1.is_in(codelist))
         .where(opa_diag.appointment_date.is_on_or_between(baseline_date, end_date))
         .sort_by(opa_diag.appointment_date)
@@ -367,38 +593,33 @@ def first_matching_event_opa_between(codelist, baseline_date, end_date, where=Tr
     )
 
 ## In EMERGENCY CARE
-def first_matching_event_ec_snomed_between(codelist, baseline_date, end_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
+@cached
+def first_matching_event_ec_snomed_between(codelist, baseline_date, end_date, where=True, cohort=True):
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(cohort)
+        .where(any_column_is_in(emergency_care_attendances, emergency_care_diagnosis_columns, codelist))
         .where(emergency_care_attendances.arrival_date.is_on_or_between(baseline_date, end_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .first_for_patient()
     )
 
 ## DEATH
+@cached
 def matching_death_between(codelist, baseline_date, end_date, where=True):
-    conditions = [
-        getattr(ons_deaths, column_name).is_in(codelist)
-        for column_name in (["underlying_cause_of_death"]+[f"cause_of_death_{i:02d}" for i in range(1, 16)])
-    ]
-    return any_of(conditions) & ons_deaths.date.is_on_or_between(baseline_date, end_date)
+    return ons_deaths.cause_of_death_is_in(codelist) & ons_deaths.date.is_on_or_between(baseline_date, end_date)
 
 ### CAUSES of DEATH without any date restrictions
+# ons_deaths.cause_of_death_is_in() tests the underlying and all 15 listed causes in one
+# condition, instead of one is_in() per column
+@cached
 def cause_of_death_matches(codelist):
-    conditions = [
-        getattr(ons_deaths, column_name).is_in(codelist)
-        for column_name in (["underlying_cause_of_death"]+[f"cause_of_death_{i:02d}" for i in range(1, 16)])
-    ]
-    return any_of(conditions)
+    return ons_deaths.cause_of_death_is_in(codelist)
 
 
 ### BMI calculation
-def most_recent_bmi(*, minimum_age_at_measurement, where=True):
+@cached
+def most_recent_bmi(*, minimum_age_at_measurement, where=True, cohort=True):
     age_threshold = patients.date_of_birth + days(
         # This is obviously inexact but, given that the dates of birth are rounded to
         # the first of the month anyway, there's no point trying to be more accurate
@@ -409,6 +630,7 @@ def most_recent_bmi(*, minimum_age_at_measurement, where=True):
         # to calculate it from height and weight measurements. Investigation has shown
         # this to have no real benefit it terms of coverage or accuracy.
         clinical_events.where(where)
+        .where(cohort)
         .where(clinical_events.ctv3_code == CTV3Code("22K.."))
         .where(clinical_events.date >= age_threshold)
         .sort_by(clinical_events.date)